@@ -1,5 +1,8 @@
 import datetime
+import hashlib
+import importlib
 import io
+import json
 import os
 import smtplib
 from email import encoders
@@ -8,7 +11,9 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from random import random
 
-from flask import Flask, request, jsonify, got_request_exception
+import py_src.metrics as metrics  # first, the startup timing starts with its import
+
+from flask import Flask, Response, request, jsonify, got_request_exception, stream_with_context
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 from flask_caching import Cache
@@ -16,10 +21,21 @@ from flask_caching import Cache
 import rollbar
 import rollbar.contrib.flask
 
-from py_src.Network import Network
 from py_src.Scenario import Scenario
-
-ALLOWED_EXTENSIONS = ['.net']
+from py_src.Network import Network
+import py_src.networkCache as networkCache
+import py_src.parallel as parallel
+import py_src.jobs as jobs
+import py_src.serializer as serializer
+import py_src.networkBlob as networkBlob
+import py_src.cohort as cohort
+import py_src.resultCache as resultCache
+import py_src.sessions as sessions
+import py_src.explanation as explanation
+
+metrics.startup_mark('imports')
+
+ALLOWED_EXTENSIONS = ['.net', '.bif']  # formats read by py_src.Network.Network
 TEMPLATE_FOLDER = os.path.abspath('./src')
 app = Flask(__name__, template_folder=TEMPLATE_FOLDER)
 app.config.from_pyfile('settings.py')
@@ -30,6 +46,11 @@ db = SQLAlchemy(app)
 CORS(app)
 
 cache = Cache(app, config={'CACHE_TYPE': 'simple'})
+networkCache.configure(app.config['NETWORK_CACHE_MAX_BYTES'], bool(app.config['CPT_FLOAT32']))
+networkCache.configure_store(app.config['MODEL_STORE_DIR'], app.config['MODEL_STORE_MAX_BYTES'])
+parallel.configure(app.config['INFERENCE_WORKERS'])
+resultCache.configure(app.config['RESULT_CACHE_MAX_BYTES'], app.config['RESULT_CACHE_TTL_SECONDS'],
+                      app.config['RESULT_CACHE_PINNED_MAX_BYTES'])
 
 with app.app_context():
     """init rollbar module"""
@@ -46,22 +67,75 @@ with app.app_context():
     # send exceptions from `app` to rollbar, using flask's signal system.
     got_request_exception.connect(rollbar.contrib.flask.report_exception, app)
 
+jobQueue = jobs.JobQueue(app.config['JOB_DATABASE'], app.config['JOB_WORKERS'], app.config['JOB_RETENTION_SECONDS'],
+                         on_error=rollbar.report_exc_info, stale_after=app.config['JOB_STALE_SECONDS'])
+sessionStore = sessions.SessionStore(app.config['SESSION_DATABASE'], app.config['SESSION_MAX_BYTES'],
+                                     app.config['SESSION_IDLE_SECONDS'])
+metrics.startup_mark('app')
+
 @app.route('/create_tables')
 def create_tables():
     db.create_all()
 
+def requestBodyCacheKey(*args, **kwargs):
+    """
+    Cache key of POST endpoints: hash of the path, the canonical JSON body, the query string and the accepted
+    encodings, so that different scenarios or networks never share a cached response
+    """
+    h = hashlib.sha256()
+    for part in (request.path,
+                 json.dumps(request.get_json(silent=True), sort_keys=True, separators=(',', ':')),
+                 json.dumps(sorted(request.args.items(multi=True))),
+                 request.headers.get('Accept-Encoding', '')):
+        h.update(part.encode())
+        h.update(b'\0')
+    return 'body:' + h.hexdigest()
+
+
+def conditionalResponse(etag, build):
+    """
+    Answers with 304 Not Modified if the client already has the version etag, otherwise with the result of build
+    :param etag: entity tag of the current version
+    :param build: function returning the response data
+    :return: response object
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # browsers revalidate with If-None-Match instead of guessing freshness
+    return response
+
+
+def networkEtag(network):
+    """
+    :param network: database entry
+    :return: entity tag of the network content and the metadata returned by getNetwork
+    """
+    h = hashlib.sha256(networkCache.network_hash(network.fileString, network.fileFormat).encode())
+    for field in (network.description, network.customization):
+        h.update(b'\0')
+        h.update((field or '').encode())
+    return h.hexdigest()
+
+
 @app.route('/getNetwork')
-@cache.cached(timeout=60, query_string=True)
 def getNetwork():
     data = request
-    network = getNetworkInDatabase(data.args.get('network')) #else load from database
-    s = Scenario(network.fileString, network.fileFormat)
-    return {'states': s.network.states, 'edges': s.network.edges, 'description': network.description,
-            'labels': s.network.labels, 'customization': network.customization}
+    with metrics.stage('db'):
+        network = getNetworkInDatabase(data.args.get('network')) #else load from database
+
+    def build():
+        s = Scenario(network.fileString, network.fileFormat, compiled=network.compiled)
+        return {'states': s.network.states, 'edges': s.network.edges, 'description': network.description,
+                'labels': s.network.labels, 'customization': network.customization}
+
+    return conditionalResponse(networkEtag(network), build)
 
 
 @app.route('/getLocalNetwork', methods=['POST'])
-@cache.cached(timeout=60, query_string=True)
+@cache.cached(timeout=60, make_cache_key=requestBodyCacheKey)
 def getLocalNetwork():
     network = request.get_json()
     s = Scenario(network["fileString"], network["fileFormat"])
@@ -69,52 +143,337 @@ def getLocalNetwork():
             'labels': s.network.labels}
 
 @app.route('/calcTargetForGoals', methods=['POST'])
+@cache.cached(timeout=60, make_cache_key=requestBodyCacheKey)
 def calcTargetForGoals():
     data = request.get_json()
-    if 'fileString' in data:
-        network = data['fileString'] #load the local network directly from user pc
-        fileFormat = data["fileFormat"]
+    return jsonResponse(computeTargetForGoals(resolveNetworkSource(data)))
+
+
+def computeTargetForGoals(data, progress=None):
+    """
+    Calculates the best target combinations for the goals
+    :param data: request data with "fileString" and "fileFormat" of the network, optionally "top_k" and "cursor"
+    to return only a page of the options
+    :param progress: optional callback taking the progress in percent
+    """
+    s = targetScenario(data)
+    if data.get('top_k') is not None:
+        # only the page of the best options starting at the cursor, see Scenario.compute_top_target_combs_for_goals
+        results, nextCursor = s.compute_top_target_combs_for_goals(int(data['top_k']), int(data.get('cursor') or 0))
     else:
-        # else load from database
-        DBitem = getNetworkInDatabase(data['network'])
-        network = DBitem.fileString
-        fileFormat = DBitem.fileFormat
-    s = Scenario(network, fileFormat, evidences=data['evidences'], targets=data['target'], goals=data['goals'],
-                 goalDirections=data['goalDirections'])
-    results = s.compute_target_combs_for_goals()
+        results, nextCursor = s.compute_target_combs_for_goals(), None
+    if progress:
+        progress(80)
     likely_results = s.compute_goals()
-    return {'optionResults': results, 'likelyResults': likely_results}
+    result = {'optionResults': results, 'likelyResults': likely_results}
+    if data.get('top_k') is not None:
+        result['nextCursor'] = nextCursor
+    return result
+
+
+def targetScenario(data):
+    return Scenario(data['fileString'], data['fileFormat'], evidences=data['evidences'], targets=data['target'],
+                    goals=data['goals'], goalDirections=data['goalDirections'], compiled=data.get('compiled'),
+                    **approximationOptions(data))
 
 
 #calculates the explanation of the chosen option
 @app.route('/calcOptions', methods=['POST'])
+@cache.cached(timeout=60, make_cache_key=requestBodyCacheKey)
 def calcOptions():
-    #data prep
     data = request.get_json()
+    error = explanationModeError(data)
+    if error is not None:
+        return error
+    return jsonResponse(computeOptions(resolveNetworkSource(data)))
+
+
+def explanationModeError(data):
+    """
+    :return: 400 response for an unknown "explanationMode", None if the mode is valid or not given
+    """
+    mode = data.get('explanationMode', 'differing')
+    if mode not in explanation.SUBSET_FUNCTIONS:
+        return {'error': f"unknown explanationMode '{mode}', expected one of "
+                         f"{', '.join(explanation.SUBSET_FUNCTIONS)}"}, 400
+    return None
+
+
+def computeOptions(data, progress=None):
+    """
+    Calculates node probabilities, relevance and explanation of the chosen option
+    :param data: request data with "fileString" and "fileFormat" of the network
+    :param progress: optional callback taking the progress in percent
+    """
+    s = optionScenario(data)
+    nodes = s.compute_all_nodes()
+    if progress:
+        progress(40)
+    result = explainOption(s, data, nodes, progress)
+    result['nodes'] = nodes
+    return result
+
+
+def optionScenario(data):
+    #data prep
     relevanceEvidences = {}
     for ev in data['evidences']:
         relevanceEvidences[ev] = data['evidences'][ev]
     for op in data['options']:
         relevanceEvidences[op] = data['options'][op]
-    if 'fileString' in data:
-        network = data['fileString']  # load the local network directly from user pc
-        fileFormat = data["fileFormat"]
+    return Scenario(data['fileString'], data['fileFormat'], evidences=relevanceEvidences, goals=data['goals'],
+                    goalDirections=data['goalDirections'], compiled=data.get('compiled'), **approximationOptions(data))
+
+
+# evidence sessions: the case is built up one finding at a time, every change only updates the affected results
+@app.route('/sessions', methods=['POST'])
+def createSession():
+    """
+    Starts a session with the request data of /calcOptions, "evidences" and "options" may be left out
+    :return: the result of /calcOptions with the "sessionId"
+    """
+    data = request.get_json()
+    error = explanationModeError(data)
+    if error is not None:
+        return error
+    data.setdefault('evidences', {})
+    data.setdefault('options', {})
+    sessionId = sessionStore.create(data)
+    result = computeSession(sessionId, data)
+    result['sessionId'] = sessionId
+    response = jsonResponse(result)
+    response.status_code = 201
+    return response
+
+
+@app.route('/sessions/<session_id>', methods=['GET'])
+def getSession(session_id):
+    data = sessionStore.get(session_id)
+    if data is None:
+        return {'error': 'unknown session'}, 404
+    return jsonResponse(computeSession(session_id, data))
+
+
+@app.route('/sessions/<session_id>/evidence', methods=['POST'])
+def updateSessionEvidence(session_id):
+    """
+    Changes the findings of a session: "add" is a dict node -> state of new or changed findings, "remove" a list
+    of nodes whose findings are dropped, "options" replaces the chosen option if given
+    :return: the result of /calcOptions for the new findings
+    """
+    change = request.get_json()
+
+    def apply(data):
+        evidences = {node: state for node, state in data['evidences'].items() if node not in change.get('remove', [])}
+        evidences.update(change.get('add', {}))
+        data['evidences'] = evidences
+        if 'options' in change:
+            data['options'] = change['options']
+        return data
+
+    data = sessionStore.update(session_id, apply)
+    if data is None:
+        return {'error': 'unknown session'}, 404
+    return jsonResponse(computeSession(session_id, data))
+
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+def deleteSession(session_id):
+    sessionStore.delete(session_id)
+    return '', 204
+
+
+def computeSession(sessionId, data):
+    """
+    Calculates the result of computeOptions from the state the session has in this worker
+    :param data: session data, the request data of /calcOptions
+    """
+    source = resolveNetworkSource(dict(data))  # the network file is not stored with the session
+    s = optionScenario(source)
+    if s.approximate:
+        return computeOptions(source)
+    with metrics.stage('nodes'):
+        results = sessionStore.evaluate(sessionId, s.network, list(s.patient.goals), s.patient.evidences)
+    if results is None:
+        return computeOptions(source)
+    nodes, distributions = results
+    result = explainOption(s, source, nodes, relevance=s.compute_relevancies_for_goals(distributions))
+    result['nodes'] = nodes
+    return result
+
+
+@app.route('/sessionStats')
+def getSessionStats():
+    return sessionStore.stats()
+
+
+# scores many patients at once, e.g. the rows of a study CSV
+@app.route('/calcCohort', methods=['POST'])
+def calcCohort():
+    data = request.get_json()
+    return jsonResponse(computeCohort(resolveNetworkSource(data)))
+
+
+def computeCohort(data, progress=None):
+    """
+    Calculates goal probabilities and ranked options for every patient
+    :param data: request data with the network, "target", "goals", "goalDirections" and either "patients",
+    a list of evidence dicts, or "csv", a CSV with one column per node and one row per patient; CSV columns that
+    are not nodes are ignored and listed in "ignoredColumns"
+    :param progress: optional callback taking the progress in percent
+    """
+    with metrics.stage('network'):
+        network = networkCache.get_network(data['fileString'], data['fileFormat'], data.get('compiled'))
+    ignoredColumns = []
+    if 'csv' in data:
+        # columns that are not nodes, like patient IDs, are reported instead of failing every row
+        patients, ignoredColumns = cohort.drop_unknown_columns(cohort.read_csv(data['csv']), network.states)
     else:
-        # else load from database
-        DBitem = getNetworkInDatabase(data['network'])
-        network = DBitem.fileString
-        fileFormat = DBitem.fileFormat
+        patients = data['patients']
+    results = cohort.evaluate_cohort(network, patients, data['target'], data['goals'], data['goalDirections'],
+                                     progress)
+    return {'results': results, 'ignoredColumns': ignoredColumns}
 
+
+def approximationOptions(data):
+    """
+    Requests can ask for approximate inference with "approximate": true (optionally with a "samples" budget)
+    or force exact inference with false; otherwise networks above the configured size are approximated
+    :return: keyword arguments of Scenario
+    """
+    return {'approximate': data.get('approximate'),
+            'samples': min(int(data.get('samples', app.config['APPROXIMATE_SAMPLES'])), app.config['APPROXIMATE_MAX_SAMPLES']),
+            'approximate_above': app.config['APPROXIMATE_ABOVE_CLIQUE_ENTRIES']}
+
+
+def explainOption(s, data, nodes, progress=None, relevance=None):
     #explanation calculation
-    s = Scenario(network, fileFormat, evidences=relevanceEvidences, goals=data['goals'],
-                 goalDirections=data['goalDirections'])
-    nodes = s.compute_all_nodes()
-    relevance = s.compute_relevancies_for_goals()
+    if relevance is None:
+        relevance = s.compute_relevancies_for_goals()
+    if progress:
+        progress(70)
     most_relevant_nodes = list(map(lambda a: a['node_name'],
                                    filter(lambda n: n['overall_relevance'] >= 0.2 or n['node_name'] in data['options'].keys(),
                                           relevance)))
-    explanation = s.compute_explanation_of_goals({}, most_relevant_nodes, nodes)
-    return {'relevance': relevance, 'nodes': nodes, 'explanation': explanation}
+    explanation = s.compute_explanation_of_goals({}, most_relevant_nodes, nodes,
+                                                 mode=data.get('explanationMode', 'differing'),
+                                                 map_query_budget=app.config['EXPLANATION_MAP_QUERY_BUDGET'])
+    return {'relevance': relevance, 'explanation': explanation}
+
+
+def jsonResponse(result):
+    """
+    Serializes a calculation result, honouring the query parameters "precision" (decimal digits of floats)
+    and "layout=columnar" (node distributions as packed arrays), and compresses it if the client accepts it
+    :param result: dict returned by one of the compute functions
+    :return: response object
+    """
+    body = serializer.dumps(result, precision=request.args.get('precision', type=int),
+                            columnar=request.args.get('layout') == 'columnar').encode()
+    body, encoding = serializer.compress(body, request.accept_encodings, app.config['RESPONSE_COMPRESSION_MIN_BYTES'])
+    response = Response(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.content_encoding = encoding
+    return response
+
+
+def resolveNetworkSource(data):
+    """
+    Makes sure the request data contains the network file, loading it from the database if only a name is given
+    :param data: request data with either "fileString" and "fileFormat" or "network"
+    :return: the same dict
+    """
+    if 'fileString' not in data:
+        # load from database
+        with metrics.stage('db'):
+            DBitem = getNetworkInDatabase(data['network'])
+        data['fileString'] = DBitem.fileString
+        data['fileFormat'] = DBitem.fileFormat
+        data['compiled'] = DBitem.compiled
+    return data
+
+
+# streaming variants: every node / option is sent as one record as soon as it is computed,
+# followed by a summary record with the rest of the result
+@app.route('/stream/calcTargetForGoals', methods=['POST'])
+def streamCalcTargetForGoals():
+    data = resolveNetworkSource(request.get_json())
+
+    def records():
+        s = targetScenario(data)
+        for option in s.iter_target_combs_for_goals():
+            yield {'type': 'option', 'data': option}
+        yield {'type': 'summary', 'data': {'likelyResults': s.compute_goals()}}
+
+    return streamRecords(records())
+
+
+@app.route('/stream/calcOptions', methods=['POST'])
+def streamCalcOptions():
+    data = request.get_json()
+    error = explanationModeError(data)
+    if error is not None:
+        return error
+    data = resolveNetworkSource(data)
+
+    def records():
+        s = optionScenario(data)
+        nodes = []
+        for node in s.iter_all_nodes():
+            nodes.append(node)
+            yield {'type': 'node', 'data': node}
+        yield {'type': 'summary', 'data': explainOption(s, data, nodes)}
+
+    return streamRecords(records())
+
+
+def streamRecords(records):
+    """
+    Streams records as newline delimited JSON, or as server-sent events if the client accepts text/event-stream
+    :param records: iterable of JSON serializable records
+    :return: streaming response
+    """
+    precision = request.args.get('precision', type=int)
+    if request.accept_mimetypes.best == 'text/event-stream':
+        lines = ('data: ' + serializer.dumps(record, precision) + '\n\n' for record in records)
+        mimetype = 'text/event-stream'
+    else:
+        lines = (serializer.dumps(record, precision) + '\n' for record in records)
+        mimetype = 'application/x-ndjson'
+    # no buffering in proxies, so records arrive as soon as they are computed
+    return Response(stream_with_context(lines), mimetype=mimetype, headers={'X-Accel-Buffering': 'no'})
+
+
+# long running calculations can be submitted as jobs and polled, instead of holding the request open
+@app.route('/jobs/calcTargetForGoals', methods=['POST'])
+def submitCalcTargetForGoals():
+    data = resolveNetworkSource(request.get_json())  # the database is only available in the request context
+    return {'jobId': jobQueue.submit('calcTargetForGoals', computeTargetForGoals, data)}, 202
+
+
+@app.route('/jobs/calcOptions', methods=['POST'])
+def submitCalcOptions():
+    data = request.get_json()
+    error = explanationModeError(data)
+    if error is not None:
+        return error
+    data = resolveNetworkSource(data)
+    return {'jobId': jobQueue.submit('calcOptions', computeOptions, data)}, 202
+
+
+@app.route('/jobs/calcCohort', methods=['POST'])
+def submitCalcCohort():
+    data = resolveNetworkSource(request.get_json())
+    return {'jobId': jobQueue.submit('calcCohort', computeCohort, data)}, 202
+
+
+@app.route('/jobs/<job_id>')
+def getJob(job_id):
+    job = jobQueue.get(job_id)
+    if job is None:
+        return {'error': 'unknown job'}, 404
+    return job
 
 
 def getNetworkInDatabase(network: str):
@@ -131,10 +490,60 @@ def openNetwork(selectedNet: str):
     """
     Opens a network based on the network name
     :param selectedNet: the network name as in the database
-    :return: opened PGMPy network
+    :return: opened network, shared via the network cache
     """
-    network = getNetworkInDatabase(selectedNet)
-    return Network(network.fileString)
+    with metrics.stage('db'):
+        network = getNetworkInDatabase(selectedNet)
+    return networkCache.get_network(network.fileString, network.fileFormat, network.compiled)
+
+
+@app.before_request
+def startRequestMetrics():
+    metrics.start_request()
+
+
+@app.after_request
+def addRequestMetrics(response):
+    requestMetrics = metrics.finish_request(request.endpoint or 'unknown')
+    if requestMetrics is not None:
+        response.headers['Server-Timing'] = metrics.server_timing(requestMetrics)
+        response.headers['X-Inference-Queries'] = str(requestMetrics.queries)
+    return response
+
+
+@app.route('/metrics')
+def getMetrics():
+    stats = networkCache.cache.stats()
+    results = resultCache.cache.stats()
+    body = metrics.render([
+        ('doctorbn_network_cache_hits_total', 'counter', 'Network cache hits', stats['hits']),
+        ('doctorbn_network_cache_misses_total', 'counter', 'Network cache misses', stats['misses']),
+        ('doctorbn_network_cache_evictions_total', 'counter', 'Network cache evictions', stats['evictions']),
+        ('doctorbn_network_cache_bytes', 'gauge', 'Approximate size of the cached networks', stats['size_bytes']),
+        ('doctorbn_result_cache_hits_total', 'counter', 'Inference result cache hits', results['hits']),
+        ('doctorbn_result_cache_misses_total', 'counter', 'Inference result cache misses', results['misses']),
+        ('doctorbn_result_cache_evictions_total', 'counter', 'Inference result cache evictions', results['evictions']),
+        ('doctorbn_result_cache_bytes', 'gauge', 'Approximate size of the cached inference results',
+         results['size_bytes']),
+        ('doctorbn_pinned_result_bytes', 'gauge', 'Approximate size of the cached inference results without evidence',
+         resultCache.pinned.stats()['size_bytes']),
+    ])
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/networkCacheStats')
+def getNetworkCacheStats():
+    return networkCache.cache.stats()
+
+
+@app.route('/networkMemoryReport')
+def getNetworkMemoryReport():
+    return networkCache.cache.memory_report()
+
+
+@app.route('/resultCacheStats')
+def getResultCacheStats():
+    return resultCache.stats()
 
 
 # Database object
@@ -144,6 +553,7 @@ class NetworkData(db.Model):
     displayName = db.Column(db.String(), primary_key=True, nullable=False)
     description = db.Column(db.String(), nullable=True)
     customization = db.Column(db.String(), nullable=True)
+    compiled = db.Column(db.LargeBinary(), nullable=True)  # py_src.networkBlob of the file, loaded instead of parsing it
 
     def __repr__(self):
         return self.displayName
@@ -165,21 +575,61 @@ def doesPathExist(filePath):
 
 
 # Adds a new network's data to the database and saves the file to the designated path
+# raises ValueError with the reason if the file is not a network that can be read
 def addNetwork(file, name, des):
-    newNetwork = NetworkData(fileString=readFile(file), displayName=name, description=des)
+    extension = os.path.splitext(file.filename)[1].lower()
+    if extension not in ALLOWED_EXTENSIONS:
+        raise ValueError(f"unsupported file type '{extension}', expected one of {', '.join(ALLOWED_EXTENSIONS)}")
+    try:
+        fileString = readFile(file)
+    except UnicodeDecodeError:
+        raise ValueError("the file is not a text file")
+    fileFormat = extension.lstrip('.')
+    try:
+        compiled = compileNetwork(fileString, fileFormat)
+    except Exception as e:  # the readers fail with many different exceptions on malformed files
+        raise ValueError(f"the network could not be read: {e}")
+    newNetwork = NetworkData(fileString=fileString, fileFormat=fileFormat, displayName=name, description=des,
+                             compiled=compiled)
     db.session.add(newNetwork)
     db.session.commit()
     return 'successful'
 
 
+def compileNetwork(fileString, fileFormat):
+    """
+    Parses a network once and returns its compiled blob, which workers load instead of parsing the file.
+    The blob is compiled from a fresh parse, the cached networks may hold float32 CPTs (see CPT_FLOAT32).
+    :return: blob as bytes
+    """
+    return networkBlob.compile_network(Network(fileString, fileFormat))
+
+
+@app.cli.command('compile-networks')
+def compileNetworks():
+    """
+    Migration: adds the "compiled" column to an existing network table and compiles all networks stored without it
+    """
+    table = NetworkData.__tablename__
+    if 'compiled' not in [column['name'] for column in db.inspect(db.engine).get_columns(table)]:
+        columnType = db.LargeBinary().compile(dialect=db.engine.dialect)
+        with db.engine.begin() as connection:
+            connection.execute(db.text(f'ALTER TABLE {table} ADD COLUMN compiled {columnType}'))
+
+    for network in NetworkData.query.filter(NetworkData.compiled.is_(None)).all():
+        network.compiled = compileNetwork(network.fileString, network.fileFormat)
+        db.session.commit()
+        print('compiled', network.displayName)
+
+
 # Loads the list of known networks to the application
 # returns a python dict object
 @app.route('/loadNetList')
-@cache.cached(timeout=60)
 def getNetworkList():
     networks = NetworkData.query.with_entities(NetworkData.displayName).order_by(NetworkData.displayName).all()
     netList = {i: network.displayName for i, network in enumerate(networks)}
-    return netList
+    etag = hashlib.sha256(json.dumps(list(netList.values())).encode()).hexdigest()
+    return conditionalResponse(etag, lambda: netList)
 
 
 def readFile(file):
@@ -213,7 +663,10 @@ def saveNetwork():
     if doesPathExist(filePath):
         return jsonify('error2')"""
     # add new network to database and save it
-    addNetwork(file, displayName, description)
+    try:
+        addNetwork(file, displayName, description)
+    except ValueError as e:
+        return {'error': str(e)}, 400
     return jsonify('successful')
 
 
@@ -327,5 +780,40 @@ def home():
     return 'this is the flask backend'
 
 
+# imported on first use otherwise, see py_src.Network
+INFERENCE_MODULES = ('pgmpy.readwrite', 'pgmpy.models', 'pgmpy.factors.discrete')
+
+
+def preloadNetworks(names):
+    """
+    Imports the inference stack and loads, compiles and prepares networks at startup. With gunicorn --preload
+    this runs once before the workers are forked, and all workers start with the networks in their cache.
+    :param names: display names of the networks, or ["*"] for all
+    """
+    for module in INFERENCE_MODULES:
+        importlib.import_module(module)
+    metrics.startup_mark('inference_imports')
+
+    with app.app_context():
+        query = NetworkData.query
+        if names != ['*']:
+            query = query.filter(NetworkData.displayName.in_(names))
+        for network in query.all():
+            if network.compiled is None:
+                network.compiled = compileNetwork(network.fileString, network.fileFormat)
+                db.session.commit()
+            loaded = networkCache.get_network(network.fileString, network.fileFormat, network.compiled)
+            loaded.get_junction_tree()
+        db.session.remove()
+        db.engine.dispose()  # forked workers must open their own database connections
+    metrics.startup_mark('preload')
+
+
+metrics.startup_mark('routes')
+if app.config['PRELOAD_NETWORKS']:
+    preloadNetworks([name.strip() for name in app.config['PRELOAD_NETWORKS'].split(',')])
+app.logger.info(metrics.startup_report())
+
+
 if __name__ == '__main__':
     app.run(host='localhost', debug=True, port=5000)
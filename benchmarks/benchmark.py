@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import py_src.inferenceEngine as inferenceEngine
+import py_src.networkCache as networkCache
+from py_src.Network import Network
+from py_src.Scenario import Scenario
+from networks import SyntheticNetwork
+
+"""
+Times the inference hot paths on synthetic networks (and optionally on network files) and writes the results as JSON.
+
+    python benchmarks/benchmark.py --nodes 20 40 80 --evidence 0 5 --targets 1 2 --output results.json
+
+Every stage is run --repeat times on the same scenario. The first run includes building per network
+structures (junction tree, elimination plans), it is reported separately as "cold". Cached inference results
+are cleared before every run, so all runs compute their results.
+"""
+
+
+def time_calls(function, repeat, reset=None):
+    times = []
+    for _ in range(repeat):
+        if reset is not None:
+            reset()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'cold': times[0], 'min': min(times), 'median': statistics.median(times), 'times': times}
+
+
+def clear_results(scenario):
+    # results are cached across requests by network content hash, clearing the network cache keeps them
+    inferenceEngine.clear_results()
+    if scenario.network.junction_tree is not None:
+        scenario.network.junction_tree.clear_prior()
+
+
+def pick_scenario(rng, names, sample, evidence, targets, goals):
+    """
+    Chooses disjoint evidence, target and goal nodes; evidence and goal states are taken from a forward
+    sample, so every scenario has a probability above zero
+    """
+    chosen = [str(n) for n in rng.permutation(names)[:evidence + targets + goals]]
+    if len(chosen) < evidence + targets + goals:
+        return None
+    evidences = {node: sample[node] for node in chosen[:evidence]}
+    target = chosen[evidence:evidence + targets]
+    goalNodes = chosen[evidence + targets:]
+    return evidences, target, {node: sample[node] for node in goalNodes}, {node: 'max' for node in goalNodes}
+
+
+def benchmark_network(name, fileString, fileFormat, states, sample, args, rng):
+    results = []
+
+    def record(stage, timing, **scenario):
+        results.append(dict({'network': name, 'format': fileFormat, 'stage': stage}, **scenario, **timing))
+
+    record('parse', time_calls(lambda: Network(fileString, fileFormat), args.repeat), nodes=len(states))
+
+    for evidence in args.evidence:
+        for targets in args.targets:
+            for goals in args.goals:
+                picked = pick_scenario(rng, list(states), sample, evidence, targets, goals)
+                if picked is None:
+                    continue
+                evidences, target, goalStates, directions = picked
+                scenario = {'nodes': len(states), 'evidence': evidence, 'targets': targets, 'goals': goals}
+                networkCache.cache.clear()  # cold runs start from a freshly parsed network
+
+                s = Scenario(fileString, fileFormat, evidences=evidences, targets=target, goals=goalStates,
+                             goalDirections=directions)
+                record('compute_target_combs_for_goals',
+                       time_calls(s.compute_target_combs_for_goals, args.repeat, lambda: clear_results(s)), **scenario)
+
+                # calcOptions: the chosen option is part of the evidence
+                options = {node: states[node][0] for node in target}
+                s = Scenario(fileString, fileFormat, evidences=dict(evidences, **options), goals=goalStates,
+                             goalDirections=directions)
+                record('compute_all_nodes', time_calls(s.compute_all_nodes, args.repeat, lambda: clear_results(s)),
+                       **scenario)
+                record('get_influence_of_evidences_on_goals',
+                       time_calls(s.compute_relevancies_for_goals, args.repeat, lambda: clear_results(s)), **scenario)
+                nodes = s.compute_all_nodes()
+                relevance = s.compute_relevancies_for_goals()
+                relevant = [r['node_name'] for r in relevance if r['overall_relevance'] >= 0.2 or r['node_name'] in options]
+                for mode in args.explanation_modes:
+                    record('compute_explanation_of_target',
+                           time_calls(lambda: s.compute_explanation_of_goals({}, relevant, nodes, mode=mode), args.repeat,
+                                      lambda: clear_results(s)),
+                           mode=mode, **scenario)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, nargs='+', default=[20, 40])
+    parser.add_argument('--in-degree', type=int, default=2)
+    parser.add_argument('--cardinality', type=int, default=3)
+    parser.add_argument('--formats', nargs='+', choices=['bif', 'net'], default=['bif', 'net'])
+    parser.add_argument('--network', nargs='*', default=[], help='additional .bif or .net files')
+    parser.add_argument('--evidence', type=int, nargs='+', default=[0, 3])
+    parser.add_argument('--targets', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--goals', type=int, nargs='+', default=[1])
+    parser.add_argument('--explanation-modes', nargs='+', default=['differing'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file, stdout if not given')
+    args = parser.parse_args()
+
+    results = []
+    for nodes in args.nodes:
+        synthetic = SyntheticNetwork(nodes, args.in_degree, args.cardinality, args.seed)
+        sample = synthetic.sample()
+        for fileFormat in args.formats:
+            rng = np.random.default_rng(args.seed)  # same scenarios for both formats
+            results += benchmark_network(f"synthetic-{nodes}", synthetic.to_string(fileFormat), fileFormat,
+                                         synthetic.states, sample, args, rng)
+
+    for path in args.network:
+        fileFormat = os.path.splitext(path)[1].lstrip('.').lower()
+        with open(path) as f:
+            fileString = f.read()
+        network = Network(fileString, fileFormat)
+        sample = network.model.simulate(1, seed=args.seed, show_progress=False).iloc[0].to_dict()
+        results += benchmark_network(os.path.basename(path), fileString, fileFormat, network.states, sample, args,
+                                     np.random.default_rng(args.seed))
+
+    report = {'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                              'platform': platform.platform(), 'processor': platform.processor()},
+              'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+              'results': results}
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import itertools
+
+import numpy as np
+
+"""
+Generates random Bayesian networks and writes them in the NET (Hugin) and BIF formats read by py_src.Network.
+"""
+
+
+class SyntheticNetwork:
+
+    def __init__(self, nodes, in_degree=2, cardinality=3, seed=0):
+        """
+        :param nodes: number of nodes
+        :param in_degree: maximum number of parents per node, each node gets between 0 and in_degree parents
+        :param cardinality: maximum number of states per node, each node gets between 2 and cardinality states
+        :param seed: seed of the random generator, the same arguments always give the same network
+        """
+        self.rng = np.random.default_rng(seed)
+        self.names = [f"n{i}" for i in range(nodes)]
+        self.states = {name: [f"s{j}" for j in range(int(self.rng.integers(2, cardinality + 1)))]
+                       for name in self.names}
+        self.parents = {}
+        self.tables = {}  # node -> array with one row per parent configuration, parents as in self.parents
+        for i, name in enumerate(self.names):
+            k = min(i, int(self.rng.integers(0, in_degree + 1)))
+            self.parents[name] = [self.names[j] for j in sorted(self.rng.choice(i, k, replace=False))] if k else []
+            rows = int(np.prod([len(self.states[p]) for p in self.parents[name]]))
+            self.tables[name] = self.rng.dirichlet(np.full(len(self.states[name]), 0.7), size=rows)
+
+    def sample(self):
+        """
+        Draws one joint state by forward sampling, so evidence taken from it has a probability above zero
+        :return: dict node -> state name
+        """
+        sample = {}
+        for name in self.names:  # nodes are generated in topological order
+            row = 0
+            for parent in self.parents[name]:
+                row = row * len(self.states[parent]) + self.states[parent].index(sample[parent])
+            distribution = self.tables[name][row]
+            sample[name] = self.states[name][int(self.rng.choice(len(distribution), p=distribution))]
+        return sample
+
+    def to_bif(self):
+        lines = ["network synthetic {", "}"]
+        for name in self.names:
+            lines += [f"variable {name} {{",
+                      f"  type discrete [ {len(self.states[name])} ] {{ {', '.join(self.states[name])} }};",
+                      "}"]
+        for name in self.names:
+            parents = self.parents[name]
+            if not parents:
+                lines += [f"probability ( {name} ) {{", f"  table {_join(self.tables[name][0], ', ')};", "}"]
+                continue
+            lines.append(f"probability ( {name} | {', '.join(parents)} ) {{")
+            configurations = itertools.product(*[self.states[p] for p in parents])
+            for configuration, row in zip(configurations, self.tables[name]):
+                lines.append(f"  ({', '.join(configuration)}) {_join(row, ', ')};")
+            lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    def to_net(self):
+        lines = ["net", "{", "}"]
+        for name in self.names:
+            states = " ".join(f'"{state}"' for state in self.states[name])
+            lines += [f"node {name}", "{", f'    label = "{name}";', f"    states = ({states});", "}"]
+        for name in self.names:
+            parents = self.parents[name]
+            lines.append(f"potential ({name} | {' '.join(parents)})")
+            lines.append("{")
+            lines.append(f"    data = {_nest(self.tables[name], [len(self.states[p]) for p in parents])};")
+            lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    def to_string(self, fileFormat):
+        return self.to_bif() if fileFormat == "bif" else self.to_net()
+
+
+def _join(values, separator):
+    return separator.join(repr(float(v)) for v in values)
+
+
+def _nest(table, parent_cards):
+    # NET tables nest one level of parentheses per parent, the node's own distribution is innermost
+    if not parent_cards:
+        return "(" + _join(table[0], " ") + ")"
+    block = len(table) // parent_cards[0]
+    return "(" + " ".join(_nest(table[i * block:(i + 1) * block], parent_cards[1:])
+                          for i in range(parent_cards[0])) + ")"
@@ -1,11 +1,33 @@
-from pgmpy.readwrite import NETReader
-from pgmpy.readwrite import BIFReader
 import gc
+from py_src.junctionTree import JunctionTree
+import py_src.networkBlob as networkBlob
 
 class Network:
 
-    #reads the model in NET format
-    def __init__(self, fileString, fileFormat):
+    #reads the model in NET format, or from its compiled blob or memory mapped file if one is given
+    def __init__(self, fileString, fileFormat, compiled=None, mapped=None):
+        self.fileString = fileString
+        self.fileFormat = fileFormat
+        self.model = None
+        try:
+            if mapped is not None:
+                self.model, self.states, self.edges, self.labels = networkBlob.read_mapped(mapped)
+            elif compiled is not None:
+                self.model, self.states, self.edges, self.labels = networkBlob.load_network(compiled)
+        except networkBlob.IncompatibleBlob:
+            pass  # written by another version, parse the text instead
+
+        if self.model is None:
+            self._parse(fileString, fileFormat)
+
+        self.junction_tree = None
+        self.hash = None  # content hash, set by the network cache
+        self.deterministic_cpds = None  # set by py_src.compactCpds.compact
+
+    def _parse(self, fileString, fileFormat):
+        # pgmpy is imported on first use, importing it (and torch with it) takes seconds and most requests of a
+        # worker only load compiled networks or don't touch networks at all
+        from pgmpy.readwrite import NETReader, BIFReader
         if fileFormat == "net":
             reader = NETReader(string=fileString.replace('\r\n', '\n'), n_jobs=1)
             self.model = reader.get_model()
@@ -20,3 +42,8 @@ class Network:
             self.edges = reader.variable_edges
             self.labels = {key: key for key in self.states}
 
+    # builds the junction tree on first use, it is shared by all requests using this network
+    def get_junction_tree(self):
+        if self.junction_tree is None:
+            self.junction_tree = JunctionTree(self.model)
+        return self.junction_tree
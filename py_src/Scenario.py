@@ -1,9 +1,14 @@
 from py_src.Patient import Patient
-from py_src.Network import Network
-from pgmpy import inference
+import py_src.networkCache as networkCache
+import py_src.inferenceEngine as inferenceEngine
+import py_src.approximateEngine as approximateEngine
+import py_src.parallel as parallel
 import py_src.relevance as relevance
 import py_src.explanation as explanation
+import py_src.metrics as metrics
 import numpy as np
+import heapq
+import itertools
 import py_src.sumNDimensionalArray as sumND
 
 
@@ -11,104 +16,172 @@ class Scenario:
     targets = []
     goals = {}
 
-    def __init__(self, network, fileFormat, evidences=None, targets=None, goals=None, goalDirections=None):
+    def __init__(self, network, fileFormat, evidences=None, targets=None, goals=None, goalDirections=None,
+                 compiled=None, approximate=None, samples=approximateEngine.DEFAULT_SAMPLES, approximate_above=None):
+        """
+        :param approximate: True to use likelihood weighting for nodes, goals and target combinations, False for
+        exact inference, None to decide by approximate_above
+        :param samples: sample budget of the approximation
+        :param approximate_above: networks whose largest junction tree clique has more entries are approximated
+        """
 
         self.patient = Patient()
-        self.network = Network(network, fileFormat)
+        with metrics.stage('network'):
+            self.network = networkCache.get_network(network, fileFormat, compiled)
         if evidences is not None: self.patient.evidences = evidences
         if targets is not None: self.patient.targets = targets
         if goals is not None: self.patient.goals = goals
         if goalDirections is not None: self.patient.goalDirections = goalDirections
 
-    # computes the values for the targets
+        if approximate is None:
+            approximate = bool(approximate_above) and \
+                          max(self.network.get_junction_tree().clique_entries) > approximate_above
+        self.approximate = approximate
+        self.samples = samples
+
+    # the exact engine, or the sampling engine in approximate mode
+    def get_engine(self):
+        if self.approximate:
+            return approximateEngine.get_engine(self.network.model, self.samples)
+        return inferenceEngine.get_engine(self.network.model)
+
+    # computes the values for the targets, with the sampling engine in approximate mode
     def compute_targets(self):
-        infer = inference.VariableElimination(self.network.model)
+        infer = self.get_engine()
 
         for t in self.patient.targets:
             node = self.patient.targets[t]
-            node.distribution = infer.query([node.name], evidence=self.patient.evidences, show_progress=False)
+            node.distribution = infer.query([node.name], evidence=self.patient.evidences)
 
     # computes the values for the goals
+    @metrics.timed('goals')
     def compute_goals(self):
-        infer = inference.VariableElimination(self.network.model)
-
-        distribution = infer.query(list(self.patient.goals.keys()), evidence=self.patient.evidences, show_progress=False)
-        value = distribution.values
-        goalValues = {}
-        for i, goal in enumerate(distribution.variables):
-            optionNum = distribution.name_to_no[goal][self.patient.goals[goal]]
-            value = value[optionNum]
-            dimension = distribution.variables.index(goal)
-            singleGoalDist = sumND.getMarginalProbability(distribution.values, dimension)
-            goalValues[goal] = singleGoalDist[optionNum]
-
-        return {'value': value, 'goalValues': goalValues}
-
-    def compute_relevancies_for_goals(self):
-        return relevance.get_influence_of_evidences_on_goals(self.network.model,
+        infer = self.get_engine()
+
+        if self.approximate:
+            distribution, error = infer.query_with_error(list(self.patient.goals.keys()), evidence=self.patient.evidences)
+        else:
+            distribution = infer.query(list(self.patient.goals.keys()), evidence=self.patient.evidences)
+        result = summarize_goals(distribution.values, distribution.variables, distribution.name_to_no, self.patient.goals)
+        if self.approximate:
+            result['standardError'] = error[tuple(distribution.name_to_no[goal][self.patient.goals[goal]]
+                                                  for goal in distribution.variables)]
+        return result
+
+    @metrics.timed('relevance')
+    def compute_relevancies_for_goals(self, distributions=None):
+        """
+        :param distributions: optional goal distributions with all evidences and with every evidence left out,
+        e.g. kept by an evidence session
+        """
+        return relevance.get_influence_of_evidences_on_goals(self.network,
                                                              self.patient.evidences,
                                                              self.patient.goals,
-                                                             self.patient.goalDirections)
+                                                             self.patient.goalDirections,
+                                                             distributions)
 
-    def compute_explanation_of_goals(self, interventions, most_relevant_nodes, nodes):
+    @metrics.timed('explanation')
+    def compute_explanation_of_goals(self, interventions, most_relevant_nodes, nodes, mode='differing',
+                                     map_query_budget=None):
         return explanation.compute_explanation_of_target(self.network.model,
                                                          self.patient.evidences,
                                                          interventions,
                                                          self.patient.goals,
                                                          most_relevant_nodes,
-                                                         nodes)
+                                                         nodes,
+                                                         mode,
+                                                         map_query_budget)
 
+    @metrics.timed('target_combs')
     def compute_target_combs_for_goals(self):
-        infer = inference.VariableElimination(self.network.model)
-
-        states = []
-        n = [1]
-        # get dict with all states
-        for target in self.patient.targets:
-            states.append({'name': target, 'states': self.network.states[target]})
-            n.append(n[len(n) - 1] * len(self.network.states[target]))
-
-        results = []
-        for i in range(n[len(n) - 1]):
-            goalNames = self.patient.goals.keys()
-            simEvidence = self.patient.evidences.copy()
-            option = {}
-
-            index = i
-            for j, target in sorted(enumerate(states), reverse=True):
-                simEvidence[target['name']] = states[j]['states'][int(index / n[j])]  # add targets as evidence
-                option[target['name']] = states[j]['states'][int(index / n[j])]
-                index = index % n[j]
-
-            distribution = infer.query(list(goalNames), evidence=simEvidence, show_progress=False)
-            value = distribution.values  # conditional probability table CPT
-            goalValues = {}
-            for i, goal in enumerate(distribution.variables):
-                optionNum = distribution.name_to_no[goal][self.patient.goals[goal]]
-                if self.patient.goalDirections[goal] == "max":
-                    value = value[optionNum]  # singles down the CPT on selected goals, one goal each iteration
-                if self.patient.goalDirections[goal] == "min":
-                    # sum over all other columns and add them together
-                    opposite_value = []
-                    for j, column in enumerate(value):
-                        if j == optionNum:
-                            continue
-                        if optionNum == 0 and j == 1 or optionNum != 0 and j == 0:
-                            opposite_value = column
-                        else:
-                            opposite_value += column
-                    value = opposite_value
-
-                dimension = distribution.variables.index(goal)
-                singleGoalDist = sumND.getMarginalProbability(distribution.values, dimension)
-                goalValues[goal] = singleGoalDist[optionNum]
-
-            results.append({'option': option, 'value': value, 'goalValues': goalValues})
-        results.sort(key=lambda a: a['value'], reverse=True)  # sort by overall probability of achieving goals
-        return results
+        return list(self.iter_target_combs_for_goals())
+
+    def iter_target_combs_for_goals(self):
+        """
+        Yields the target combinations sorted by the probability of achieving the goals. All combinations
+        come out of one joint query, so the first one is available as soon as that query is done.
+        """
+        infer = self.get_engine()
+
+        targets = list(self.patient.targets)
+        goalNames = list(self.patient.goals.keys())
+        # the targets replace any evidence given for them
+        evidence = {e: self.patient.evidences[e] for e in self.patient.evidences if e not in targets}
+
+        name_to_no = dict(infer.state_numbers)
+        if parallel.enabled() and targets and not self.approximate:
+            # split the joint query by the states of the last target and run the parts in the worker processes;
+            # each part is normalized on its own, which cancels out when conditioning on all targets below
+            last = targets[-1]
+            queries = [(goalNames + targets[:-1], dict(evidence, **{last: state})) for state in self.network.states[last]]
+            values = np.stack(parallel.map_queries(self.network, query_values, queries))
+            variables = [last] + goalNames + targets[:-1]
+            name_to_no[last] = {state: i for i, state in enumerate(self.network.states[last])}
+        else:
+            # one joint query P(goals, targets | evidence) instead of one query per target combination
+            distribution = infer.query(goalNames + targets, evidence=evidence)
+            values = distribution.values
+            variables = distribution.variables
+        results = rank_target_combinations(self.network, values, variables, name_to_no, targets,
+                                           self.patient.goals, self.patient.goalDirections)
+        if self.approximate:
+            self._add_option_errors(infer, evidence, targets, goalNames, results)
+        yield from results
+
+    @metrics.timed('target_combs')
+    def compute_top_target_combs_for_goals(self, top_k, cursor=0):
+        """
+        Returns one page of the ranking of compute_target_combs_for_goals. Targets that are d-separated from the
+        goals given the evidence and the relevant targets are left out of the joint query, so only the
+        combinations of the relevant targets are computed and ranked.
+        :param top_k: number of options to return
+        :param cursor: rank of the first option to return
+        :return: (options, rank of the next option or None after the last page)
+        """
+        targets = list(self.patient.targets)
+        total = int(np.prod([len(self.network.states[t]) for t in targets]))
+        if self.approximate:
+            results = list(self.iter_target_combs_for_goals())[cursor:cursor + top_k]
+        else:
+            infer = self.get_engine()
+            goalNames = list(self.patient.goals.keys())
+            evidence = {e: self.patient.evidences[e] for e in self.patient.evidences if e not in targets}
+            reached = infer.observed_reachable(goalNames, set(evidence) | set(targets))
+            relevant = [t for t in targets if t in reached]
+            distribution = infer.query(goalNames + relevant, evidence=evidence)
+            optionValues, goalValues = target_option_values(self.network, distribution.values, distribution.variables,
+                                                            infer.state_numbers, relevant, self.patient.goals,
+                                                            self.patient.goalDirections)
+            results = list(select_target_combinations(self.network, optionValues, goalValues, relevant, targets,
+                                                      cursor, top_k))
+        nextCursor = cursor + top_k if cursor + top_k < total else None
+        return results, nextCursor
+
+    def _add_option_errors(self, infer, evidence, targets, goals, results):
+        # standard error of every option value, from the samples grouped by target combination
+        samples = infer.sample(evidence)
+        achieved = np.ones(len(samples))
+        for goal in goals:
+            mask = np.zeros(infer.cardinality[goal])
+            mask[infer.state_numbers[goal][self.patient.goals[goal]]] = 1
+            if self.patient.goalDirections[goal] == "min":
+                mask = 1 - mask
+            achieved *= mask[samples.states[infer.index[goal]]]
+        _, errors, effective = samples.grouped_means(targets, achieved)
+        shape = [infer.cardinality[t] for t in targets]
+        for result in results:
+            i = np.ravel_multi_index([infer.state_numbers[t][result['option'][t]] for t in targets], shape)
+            result['standardError'] = errors[i]
+            result['effectiveSamples'] = effective[i]
 
+    @metrics.timed('nodes')
     def compute_all_nodes(self):
-        infer = inference.VariableElimination(self.network.model)
+        return list(self.iter_all_nodes())
+
+    def iter_all_nodes(self):
+        """
+        Yields the result of every node as soon as it is computed, evidence nodes first
+        """
         # sort out which nodes are already given or have to be calculated
         nodes = []
         calcNodes = []
@@ -117,25 +190,217 @@ class Scenario:
                 nodes.append({"name": node, "state": self.patient.evidences[node], "probability": 1})
             else:
                 calcNodes.append(node)
+        yield from nodes
+
+        if self.approximate:
+            # two sets of weighted samples, with and without evidence, give all marginals
+            infer = self.get_engine()
+            samples = infer.sample(self.patient.evidences)
+            samples_wo_evidence = infer.sample()
+            distributions = [samples.distribution([node]) for node in calcNodes]
+            results = node_results(calcNodes, [distribution for distribution, _ in distributions],
+                                   [samples_wo_evidence.distribution([node])[0] for node in calcNodes],
+                                   [dict(enumerate(infer.state_names[node])) for node in calcNodes])
+            for result, (_, errors) in zip(results, distributions):
+                result["standardErrors"] = errors.tolist()
+                yield result
+            return
+
+        junction_tree = self.network.get_junction_tree()
+        if junction_tree.tractable:
+            # calibrate once with and once without evidence and read off all marginals together
+            calibrated = junction_tree.calibrate(self.patient.evidences)
+            calibrated_wo_evidence = junction_tree.calibrate()
+            yield from node_results(calcNodes, [calibrated.marginal(node) for node in calcNodes],
+                                    [calibrated_wo_evidence.marginal(node) for node in calcNodes],
+                                    [dict(enumerate(junction_tree.state_names[node])) for node in calcNodes])
+            return
+
+        # treewidth too large for the junction tree, query every node separately
+        distributions = parallel.imap_queries(self.network, query_node,
+                                              [(node, self.patient.evidences) for node in calcNodes])
+        for node, (stateProbabilities, stateProbabilities_wo_evidence, allStateNames) in zip(calcNodes, distributions):
+            yield node_result(node, stateProbabilities, stateProbabilities_wo_evidence, allStateNames)
+
+
+# calculate node attributes
+def node_result(node, stateProbabilities, stateProbabilities_wo_evidence, allStateNames, divergence=None):
+    if divergence is None:
+        divergence = relevance.compute_jensen_shannon_divergence(stateProbabilities, stateProbabilities_wo_evidence)
+    maxProbability = np.amax(stateProbabilities)
+    state = np.where(stateProbabilities == maxProbability)[0][0]
+    stateName = allStateNames[state]
+    return {"name": node, "state": stateName, "probability": maxProbability, "divergence": divergence,
+            "stateNames": allStateNames,
+            "distribution": stateProbabilities.tolist(),
+            "distribution_wo_evidence": stateProbabilities_wo_evidence.tolist()}
+
+
+def node_results(nodes, distributions, distributions_wo_evidence, allStateNames):
+    """
+    Same as node_result for many nodes, computing the divergences of all of them at once
+    :param distributions: list with the distribution of every node, same for the other lists
+    :return: list of node results
+    """
+    divergences = relevance.compute_jensen_shannon_divergences(distributions, distributions_wo_evidence)
+    return [node_result(node, p, p_wo, names, float(divergence)) for node, p, p_wo, names, divergence
+            in zip(nodes, distributions, distributions_wo_evidence, allStateNames, divergences)]
+
+
+def select_target_combinations(network, optionValues, goalValues, relevant, targets, offset, count):
+    """
+    Yields a page of the ranking of all target combinations without enumerating them all. The targets outside
+    of relevant do not change the goal probabilities, so every combination of the relevant targets stands for
+    all combinations of the other targets, with the same values.
+    :param optionValues: option values of the relevant target combinations, see target_option_values
+    :param goalValues: dict goal -> values of the single goal of the relevant target combinations
+    :param relevant: the targets the values depend on, in the order of targets
+    :param targets: all targets
+    :param offset: rank of the first option to return
+    :param count: number of options to return
+    :return: options in the order of rank_target_combinations over all targets
+    """
+    # position of every combination in the enumeration of all targets, which breaks ties as the full ranking does
+    stride = {}
+    size = 1
+    for t in targets:
+        stride[t] = size
+        size *= len(network.states[t])
+    free = [t for t in targets if t not in relevant]
+    freeCount = size // int(np.prod([len(network.states[t]) for t in relevant]))
+
+    def free_assignments(i, combination, first=0):
+        # (position, relevant combination, full option) in the order of the positions, from the first-th on
+        base = sum(stride[t] * network.states[t].index(state) for t, state in combination.items())
+        for k in range(first, freeCount):
+            option = dict(combination)
+            position = base
+            for t in free:
+                k, state = divmod(k, len(network.states[t]))
+                option[t] = network.states[t][state]
+                position += stride[t] * state
+            yield position, i, {t: option[t] for t in targets[::-1]}
+
+    rounded = np.round(optionValues, 12)
+    order = np.lexsort((np.arange(len(rounded)), -rounded))
+    sortedValues = rounded[order]
+    bounds = np.concatenate(([0], np.flatnonzero(sortedValues[1:] != sortedValues[:-1]) + 1, [len(order)]))
+    shape = [len(network.states[t]) for t in relevant[::-1]]
+
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if count <= 0:
+            return
+        groupSize = (end - start) * freeCount
+        if offset >= groupSize:
+            offset -= groupSize  # skip groups before the page without expanding them
+            continue
+        streams = []
+        for i in order[start:end]:
+            positions = np.unravel_index(i, shape)
+            combination = {t: network.states[t][p] for t, p in zip(relevant[::-1], positions)}
+            streams.append((i, combination))
+        if len(streams) == 1:
+            page = free_assignments(*streams[0], first=offset)
+        else:
+            # combinations with equal values are ranked by their position in the enumeration
+            merged = heapq.merge(*[free_assignments(i, combination) for i, combination in streams], key=lambda x: x[0])
+            page = itertools.islice(merged, offset, None)
+        for _, i, option in itertools.islice(page, count):
+            yield {'option': option, 'value': optionValues[i],
+                   'goalValues': {goal: values[i] for goal, values in goalValues.items()}}
+            count -= 1
+        offset = 0
+
+
+def summarize_goals(values, variables, name_to_no, goals):
+    """
+    :param values: joint distribution over the goals, one axis per entry of variables
+    :param name_to_no: dict variable -> state name -> index along its axis
+    :return: probability of achieving all goals together and of every single goal
+    """
+    value = values
+    goalValues = {}
+    for goal, singleGoalDist in zip(variables, sumND.getMarginalProbabilities(values)):
+        optionNum = name_to_no[goal][goals[goal]]
+        value = value[optionNum]
+        goalValues[goal] = singleGoalDist[optionNum]
+    return {'value': value, 'goalValues': goalValues}
+
+
+def target_option_values(network, values, variables, name_to_no, targets, goals, goalDirections):
+    """
+    Computes the probability of achieving the goals for every target combination
+    :param network: py_src.Network.Network object
+    :param values: joint distribution over goals and targets, one axis per entry of variables
+    :param variables: variables of the axes of values
+    :param name_to_no: dict variable -> state name -> index along its axis
+    :return: (option values, dict goal -> values of the single goal), indexed by combination in enumeration
+    order, where the first target changes fastest
+    """
+    goalOrder = [v for v in variables if v in goals]
+
+    # axes: targets in reverse order, so that flattening lets the first target change fastest, then goals
+    values = np.transpose(values, [variables.index(v) for v in targets[::-1] + goalOrder])
+    for axis, target in enumerate(targets[::-1]):
+        stateNums = [name_to_no[target][state] for state in network.states[target]]
+        values = np.take(values, stateNums, axis=axis)
+    values = values.reshape((-1,) + values.shape[len(targets):])
+
+    # condition the goals on every target combination
+    goalAxes = tuple(range(1, values.ndim))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        conditional = values / values.sum(axis=goalAxes, keepdims=True)
+
+    # "max" goals keep only the selected state, "min" goals sum over all other states
+    selected = conditional
+    goalValues = {}
+    singleGoalDists = sumND.getMarginalProbabilities(conditional, batchAxes=1)
+    for k, goal in enumerate(goalOrder):
+        optionNum = name_to_no[goal][goals[goal]]
+        mask = np.zeros(values.shape[k + 1])
+        mask[optionNum] = 1
+        if goalDirections[goal] == "min":
+            mask = 1 - mask
+        shape = [1] * values.ndim
+        shape[k + 1] = len(mask)
+        selected = selected * mask.reshape(shape)
+
+        goalValues[goal] = singleGoalDists[k][:, optionNum]
+    return selected.sum(axis=goalAxes), goalValues
+
+
+def rank_target_combinations(network, values, variables, name_to_no, targets, goals, goalDirections):
+    """
+    Ranks all target combinations by the probability of achieving the goals
+    :param network: py_src.Network.Network object
+    :param values: joint distribution over goals and targets, one axis per entry of variables
+    :param variables: variables of the axes of values
+    :param name_to_no: dict variable -> state name -> index along its axis
+    :return: list of options with their values, best first
+    """
+    optionValues, goalValues = target_option_values(network, values, variables, name_to_no, targets, goals,
+                                                    goalDirections)
+    results = []
+    for i, combination in enumerate(itertools.product(*[network.states[t] for t in targets[::-1]])):
+        option = dict(zip(targets[::-1], combination))
+        results.append({'option': option, 'value': optionValues[i],
+                        'goalValues': {goal: values[i] for goal, values in goalValues.items()}})
+    # sort by overall probability of achieving goals; targets without influence on the goals give values
+    # that only differ by rounding errors, these stay in enumeration order
+    results.sort(key=lambda a: round(a['value'], 12), reverse=True)
+    return results
+
+
+# queries run by parallel.map_queries have to be module level functions
+
+def query_values(network, variables, evidence):
+    return inferenceEngine.get_engine(network.model).query(variables, evidence=evidence).values
+
 
-        for node in calcNodes:
-            # calculate probabilities with evidence
-            distribution = infer.query([node], evidence=self.patient.evidences, show_progress=False)
-            stateProbabilities = distribution.values
-            allStateNames = distribution.no_to_name[node]
-
-            # calculate probabilities without evidence
-            distribution_wo_evidence = infer.query([node], show_progress=False)
-            stateProbabilities_wo_evidence = distribution_wo_evidence.values
-
-            # calculate node attributes
-            divergence = relevance.compute_jensen_shannon_divergence(stateProbabilities, stateProbabilities_wo_evidence)
-            maxProbability = np.amax(stateProbabilities)
-            state = np.where(stateProbabilities == maxProbability)[0][0]
-            stateName = distribution.no_to_name[node][state]
-            nodes.append({"name": node, "state": stateName, "probability": maxProbability, "divergence": divergence,
-                          "stateNames": allStateNames,
-                          "distribution": list(stateProbabilities),
-                          "distribution_wo_evidence": list(stateProbabilities_wo_evidence)})
-
-        return nodes
+def query_node(network, node, evidence):
+    infer = inferenceEngine.get_engine(network.model)
+    # calculate probabilities with evidence
+    distribution = infer.query([node], evidence=evidence)
+    # calculate probabilities without evidence
+    distribution_wo_evidence = infer.query([node])
+    return distribution.values, distribution_wo_evidence.values, distribution.no_to_name[node]
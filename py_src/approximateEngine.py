@@ -0,0 +1,205 @@
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+import py_src.metrics as metrics
+
+"""
+Approximate inference by likelihood weighting, for networks whose treewidth is too large for exact inference.
+All samples of one evidence set are drawn together, one vectorized step per node in topological order.
+Estimates are self-normalized weighted frequencies, their standard errors use the usual delta method
+approximation sqrt(sum w_i^2 (f_i - estimate)^2) / sum w_i.
+"""
+
+DEFAULT_SAMPLES = 20000
+# sample sets kept per engine, one per evidence set
+MAX_SAMPLE_SETS = 8
+
+
+def _weighted_means(index, size, values, weights):
+    """
+    Self-normalized weighted means of values grouped by index, with standard errors
+    :param index: group of every sample
+    :param size: number of groups
+    :param values: value of every sample
+    :param weights: weight of every sample
+    :return: (means, standard errors, effective sample sizes), nan for groups without weight
+    """
+    total = np.bincount(index, weights, minlength=size)
+    squares = weights ** 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.bincount(index, weights * values, minlength=size) / total
+        errors = np.sqrt(np.bincount(index, squares * (values - means[index]) ** 2, minlength=size)) / total
+        # the errors are unreliable for groups with few effective samples, e.g. zero if all of them agree
+        effective = total ** 2 / np.bincount(index, squares, minlength=size)
+    return means, errors, effective
+
+
+class Samples:
+    """
+    Weighted samples of all variables given one evidence set
+    """
+
+    def __init__(self, engine, states, weights):
+        self.engine = engine
+        self.states = states  # one row of state numbers per variable, in engine.index order
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.weights)
+
+    def joint_index(self, variables):
+        """
+        :return: flat index of the joint state of the variables for every sample, the last variable changes fastest
+        """
+        shape = [self.engine.cardinality[var] for var in variables]
+        if not variables:
+            return np.zeros(len(self), dtype=np.intp), shape
+        return np.ravel_multi_index([self.states[self.engine.index[var]] for var in variables], shape), shape
+
+    def distribution(self, variables):
+        """
+        :param variables: list of variables
+        :return: (estimated joint distribution, standard errors), both with one axis per variable
+        """
+        index, shape = self.joint_index(variables)
+        size = int(np.prod(shape))
+        total = self.weights.sum()
+        squares = self.weights ** 2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.bincount(index, self.weights, minlength=size) / total
+            # sum of w^2 (indicator - p)^2 over all samples, split into the samples inside and outside the cell
+            inside = np.bincount(index, squares, minlength=size)
+            errors = np.sqrt(inside * (1 - values) ** 2 + (squares.sum() - inside) * values ** 2) / total
+        return values.reshape(shape), errors.reshape(shape)
+
+    def grouped_means(self, variables, values):
+        """
+        :param variables: variables to group the samples by
+        :param values: value of every sample
+        :return: (means, standard errors, effective sample sizes) per joint state of the variables, flattened
+        with the last variable fastest
+        """
+        index, shape = self.joint_index(variables)
+        return _weighted_means(index, int(np.prod(shape)), values, self.weights)
+
+
+class ApproximateEngine:
+    """
+    Same query interface as py_src.inferenceEngine.InferenceEngine, answered from weighted samples
+    """
+
+    def __init__(self, model, samples=DEFAULT_SAMPLES, seed=0):
+        self.samples = samples
+        self.seed = seed
+        self.cpds = {cpd.variable: cpd for cpd in model.get_cpds()}
+        self.state_names = {var: list(cpd.state_names[var]) for var, cpd in self.cpds.items()}
+        self.state_numbers = {var: {state: i for i, state in enumerate(states)}
+                              for var, states in self.state_names.items()}
+        self.cardinality = {var: len(states) for var, states in self.state_names.items()}
+
+        # topological order, so that the parents of a node are sampled before the node
+        self.order = []
+        done = set()
+        for node in model.nodes():
+            stack = [node]
+            while stack:
+                var = stack[-1]
+                if var in done:
+                    stack.pop()
+                    continue
+                pending = [p for p in self.cpds[var].variables[1:] if p not in done]
+                if pending:
+                    stack.extend(pending)
+                else:
+                    done.add(var)
+                    self.order.append(var)
+                    stack.pop()
+        self.index = {var: i for i, var in enumerate(self.order)}
+        self.dtype = np.min_scalar_type(max(self.cardinality.values()))
+
+        self._sample_sets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def sample(self, evidence=None):
+        """
+        Draws (or returns the cached) weighted samples for an evidence set; the generator is seeded per
+        engine, so the same evidence always gives the same estimates
+        :param evidence: dict variable -> observed state name
+        :return: Samples object
+        """
+        evidence = evidence or {}
+        key = frozenset(evidence.items())
+        with self._lock:
+            samples = self._sample_sets.get(key)
+            if samples is not None:
+                self._sample_sets.move_to_end(key)
+                return samples
+
+        metrics.count_queries()
+        rng = np.random.default_rng(self.seed)
+        n = self.samples
+        states = np.empty((len(self.order), n), dtype=self.dtype)
+        log_weights = np.zeros(n)
+        for i, var in enumerate(self.order):
+            cpd = self.cpds[var]
+            parent_states = tuple(states[self.index[p]] for p in cpd.variables[1:])
+            if var in evidence:
+                state = self.state_numbers[var][evidence[var]]
+                with np.errstate(divide='ignore'):
+                    log_weights += np.log(np.broadcast_to(cpd.values[(state,) + parent_states], n))
+                states[i] = state
+            else:
+                probabilities = cpd.values[(slice(None),) + parent_states]
+                cumulative = np.cumsum(probabilities, axis=0)
+                if cumulative.ndim == 1:
+                    cumulative = cumulative[:, None]
+                drawn = (rng.random(n) * cumulative[-1] > cumulative).sum(axis=0)
+                states[i] = np.minimum(drawn, self.cardinality[var] - 1)
+
+        with np.errstate(invalid='ignore'):
+            weights = np.exp(log_weights - log_weights.max()) if np.isfinite(log_weights).any() else np.zeros(n)
+        samples = Samples(self, states, weights)
+        with self._lock:
+            self._sample_sets[key] = samples
+            if len(self._sample_sets) > MAX_SAMPLE_SETS:
+                self._sample_sets.popitem(last=False)
+        return samples
+
+    def query_with_error(self, variables, evidence=None):
+        """
+        :param variables: list of query variables
+        :param evidence: dict variable -> observed state name
+        :return: (estimated DiscreteFactor over the variables, standard errors with the same shape)
+        """
+        from pgmpy.factors.discrete import DiscreteFactor
+
+        evidence = evidence or {}
+        common_vars = set(evidence).intersection(variables)
+        if common_vars:
+            raise ValueError(f"Can't have the same variables in both `variables` and `evidence`. Found in both: {common_vars}")
+        values, errors = self.sample(evidence).distribution(list(variables))
+        factor = DiscreteFactor(list(variables), values.shape, values,
+                                state_names={var: self.state_names[var] for var in variables})
+        return factor, errors
+
+    def query(self, variables, evidence=None):
+        return self.query_with_error(variables, evidence)[0]
+
+
+_engines = weakref.WeakKeyDictionary()
+
+
+def get_engine(model, samples=DEFAULT_SAMPLES):
+    """
+    :param model: pgmpy BayesianNetwork
+    :param samples: sample budget per evidence set
+    :return: the ApproximateEngine shared by all queries on this model with this budget
+    """
+    engines = _engines.setdefault(model, {})
+    engine = engines.get(samples)
+    if engine is None:
+        engine = engines[samples] = ApproximateEngine(model, samples)
+    return engine
@@ -0,0 +1,117 @@
+import csv
+import io
+
+import py_src.inferenceEngine as inferenceEngine
+import py_src.metrics as metrics
+from py_src.Scenario import summarize_goals, rank_target_combinations
+
+"""
+Scores many patients against one network, target and goal set. Patients observing the same evidence variables
+share one elimination plan and are contracted together with a batch axis (InferenceEngine.query_batch).
+"""
+
+
+def read_csv(text):
+    """
+    Reads patients from a CSV with one column per node and one row per patient; empty cells are unobserved
+    :param text: CSV content with a header row of node names
+    :return: list of evidence dicts
+    """
+    return [{node: state.strip() for node, state in row.items() if node and state and state.strip()}
+            for row in csv.DictReader(io.StringIO(text))]
+
+
+def drop_unknown_columns(evidences, nodes):
+    """
+    Removes the observations of variables that are not nodes of the network, e.g. ID or comment columns of a CSV
+    :param nodes: node names of the network
+    :return: (evidences without the unknown variables, sorted names of the dropped variables)
+    """
+    unknown = sorted({var for evidence in evidences for var in evidence if var not in nodes})
+    if not unknown:
+        return evidences, unknown
+    return [{var: state for var, state in evidence.items() if var in nodes} for evidence in evidences], unknown
+
+
+def validation_error(infer, evidence):
+    """
+    :param infer: InferenceEngine of the network
+    :return: readable message for the first unknown node or state of a patient, None if all are valid
+    """
+    for var, state in evidence.items():
+        if var not in infer.state_numbers:
+            return f"Unknown node '{var}'"
+        if state not in infer.state_numbers[var]:
+            return f"Unknown state '{state}' of node '{var}', expected one of {', '.join(infer.state_names[var])}"
+    return None
+
+
+def _group_by_pattern(evidences, indexes):
+    # patient indexes per set of observed variables
+    groups = {}
+    for i in indexes:
+        groups.setdefault(frozenset(evidences[i]), []).append(i)
+    return groups
+
+
+@metrics.timed('cohort')
+def evaluate_cohort(network, evidences, targets, goals, goalDirections, progress=None):
+    """
+    Computes for every patient what /calcTargetForGoals returns for it
+    :param network: py_src.Network.Network object
+    :param evidences: list of evidence dicts, one per patient
+    :param targets: list of target nodes
+    :param goals: dict goal node -> desired state
+    :param goalDirections: dict goal node -> "max" or "min"
+    :param progress: optional callback taking the progress in percent
+    :return: list with a dict of "optionResults" and "likelyResults" per patient, or of "error"
+    """
+    infer = inferenceEngine.get_engine(network.model)
+    goalNames = list(goals.keys())
+    results = [{} for _ in evidences]
+
+    # patients with unknown nodes or states get an error of their own instead of failing their whole group
+    valid = []
+    for i, evidence in enumerate(evidences):
+        error = validation_error(infer, evidence)
+        if error is None:
+            valid.append(i)
+        else:
+            results[i]['error'] = error
+
+    # the targets replace any evidence given for them in the option ranking, not in the likely results
+    optionEvidences = [{e: state for e, state in evidence.items() if e not in targets} for evidence in evidences]
+    optionGroups = _group_by_pattern(optionEvidences, valid)
+    likelyGroups = _group_by_pattern(evidences, valid)
+    total = len(optionGroups) + len(likelyGroups)
+
+    for done, indexes in enumerate(optionGroups.values()):
+        try:
+            values = infer.query_batch(goalNames + targets, [optionEvidences[i] for i in indexes])
+        except (ValueError, KeyError) as e:
+            for i in indexes:
+                results[i]['error'] = str(e)
+            continue
+        for i, patientValues in zip(indexes, values):
+            results[i]['optionResults'] = rank_target_combinations(network, patientValues, goalNames + targets,
+                                                                   infer.state_numbers, targets, goals, goalDirections)
+        if progress:
+            progress(100 * (done + 1) / total)
+
+    for done, indexes in enumerate(likelyGroups.values(), start=len(optionGroups)):
+        try:
+            values = infer.query_batch(goalNames, [evidences[i] for i in indexes])
+        except (ValueError, KeyError) as e:
+            for i in indexes:
+                results[i]['error'] = str(e)
+            continue
+        for i, patientValues in zip(indexes, values):
+            results[i]['likelyResults'] = summarize_goals(patientValues, goalNames, infer.state_numbers, goals)
+        if progress:
+            progress(100 * (done + 1) / total)
+
+    for result in results:
+        if 'error' in result:
+            result.pop('optionResults', None)
+            result.pop('likelyResults', None)
+    return results
@@ -0,0 +1,116 @@
+import sys
+
+import numpy as np
+
+"""
+Compact storage of the CPTs of parsed networks. Deterministic CPTs (every entry 0 or 1, as in the logical nodes
+of clinical networks) are stored as float32, which represents them exactly, and identical tables share one array.
+Other CPTs are stored as float32 only if requested. The state names of every variable are interned and one list
+and one set of lookup dicts is shared by all CPTs containing the variable.
+"""
+
+
+def is_deterministic(values):
+    return bool(np.all((values == 0) | (values == 1)))
+
+
+def compact(network, float32=False):
+    """
+    Compacts the CPTs of a network in place and counts its deterministic CPTs; memory mapped CPTs are already
+    shared and stay as they are. The compacted arrays are read-only.
+    :param network: py_src.Network.Network object
+    :param float32: also store the non-deterministic CPTs as float32, with a relative error of about 1e-7
+    """
+    tables = {}  # (dtype, shape, content) -> shared array
+    network.deterministic_cpds = 0
+    for cpd in network.model.get_cpds():
+        values = cpd.values
+        deterministic = is_deterministic(values)
+        network.deterministic_cpds += deterministic
+        if isinstance(values, np.memmap):
+            continue
+        if float32 or deterministic:
+            values = values.astype(np.float32)
+        key = (values.dtype.str, values.shape, values.tobytes())
+        values = tables.setdefault(key, values)
+        values.flags.writeable = False
+        cpd.values = values
+    _intern_state_names(network)
+
+
+def _intern_state_names(network):
+    states = {}
+    for cpd in network.model.get_cpds():
+        var = cpd.variable
+        states[var] = [sys.intern(str(state)) for state in cpd.state_names[var]]
+    name_to_no = {var: {state: i for i, state in enumerate(names)} for var, names in states.items()}
+    no_to_name = {var: dict(enumerate(names)) for var, names in states.items()}
+    for cpd in network.model.get_cpds():
+        for var in cpd.variables:
+            cpd.state_names[var] = states[var]
+            cpd.name_to_no[var] = name_to_no[var]
+            cpd.no_to_name[var] = no_to_name[var]
+    for node, names in network.states.items():
+        # network.states can list the states in another order than the CPTs
+        if node in states and list(names) == states[node]:
+            network.states[node] = states[node]
+
+
+def memory_report(network):
+    """
+    Estimates the memory used by a parsed network, shared arrays and strings counted once
+    :param network: py_src.Network.Network object
+    :return: dict with the approximate sizes in bytes per part and the CPT statistics
+    """
+    seen = set()
+
+    def size_of(obj):
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        return sys.getsizeof(obj)
+
+    cpt_bytes = mapped_bytes = float32 = shared = 0
+    for cpd in network.model.get_cpds():
+        values = cpd.values
+        if isinstance(values, np.memmap):
+            mapped_bytes += values.nbytes  # shared with the other workers through the page cache
+        elif id(values) in seen:
+            shared += 1
+        else:
+            seen.add(id(values))
+            cpt_bytes += values.nbytes
+        float32 += int(values.dtype == np.float32)
+
+    state_name_bytes = 0
+    for cpd in network.model.get_cpds():
+        for var in cpd.variables:
+            names = cpd.state_names[var]
+            state_name_bytes += size_of(names) + sum(size_of(name) for name in names)
+            state_name_bytes += size_of(cpd.name_to_no[var]) + size_of(cpd.no_to_name[var])
+    for node, names in network.states.items():
+        state_name_bytes += size_of(node) + size_of(names) + sum(size_of(name) for name in names)
+
+    junction_tree_bytes = 0
+    junction_tree = network.junction_tree
+    if junction_tree is not None:
+        junction_tree_bytes = sum(potential.nbytes for potential in junction_tree.potentials or [])
+        prior = junction_tree._prior
+        if prior is not None:
+            junction_tree_bytes += sum(message.nbytes for message in prior.messages.values())
+            junction_tree_bytes += sum(belief.nbytes for belief in prior._beliefs.values())
+
+    report = {'cpt_bytes': cpt_bytes,
+              'mapped_cpt_bytes': mapped_bytes,
+              'state_name_bytes': state_name_bytes,
+              'label_bytes': sys.getsizeof(network.labels) + sum(size_of(label) for label in network.labels.values()),
+              'edge_bytes': 64 * len(network.edges),
+              'file_bytes': sys.getsizeof(network.fileString),
+              'junction_tree_bytes': junction_tree_bytes,
+              'cpds': len(network.model.get_cpds()),
+              'float32_cpds': float32,
+              'deterministic_cpds': network.deterministic_cpds,  # None if the network wasn't compacted
+              'shared_cpds': shared}
+    report['total_bytes'] = sum(value for name, value in report.items()
+                                if name.endswith('_bytes') and name != 'mapped_cpt_bytes')
+    return report
@@ -1,6 +1,8 @@
-from pgmpy import inference
-from anytree import NodeMixin, RenderTree, PreOrderIter
+import py_src.inferenceEngine as inferenceEngine
+from anytree import NodeMixin
+import functools
 import itertools
+import weakref
 
 
 class Support:
@@ -15,8 +17,62 @@ class SupportNode(NodeMixin, Support):
             self.children = children
         self.forbidden_set = forbidden_set
 
-def find_changed_set(root, set, evidences, network, nodes):
-    infer = inference.VariableElimination(network)
+
+class NetworkIndex:
+    """
+    Markov blankets, parents and children of all nodes of a network, looked up once
+    """
+    def __init__(self, network):
+        self.blanket = {}
+        self.parents = {}
+        self.parent_sets = {}
+        self.children = {}
+        for node in network.nodes():
+            self.blanket[node] = network.get_markov_blanket(node)
+            self.parents[node] = network.get_parents(node)
+            self.parent_sets[node] = set(self.parents[node])
+            self.children[node] = network.get_children(node)
+
+
+_indexes = weakref.WeakKeyDictionary()
+
+
+def get_network_index(network):
+    index = _indexes.get(network)
+    if index is None:
+        index = NetworkIndex(network)
+        _indexes[network] = index
+    return index
+
+class MapQueryBudgetExceeded(Exception):
+    pass
+
+
+class MapQueryEngine:
+    """
+    MAP queries of one explanation, memoized per (query variables, evidence)
+    :param budget: maximum number of MAP queries that actually get computed, None for no limit
+    """
+    def __init__(self, network, budget=None):
+        self.infer = inferenceEngine.get_engine(network)
+        self.budget = budget
+        self.queries = 0
+        self._results = {}
+
+    def map_query(self, variables, evidence=None):
+        evidence = evidence or {}
+        key = (tuple(variables), frozenset(evidence.items()))
+        if key not in self._results:
+            if self.budget is not None and self.queries >= self.budget:
+                raise MapQueryBudgetExceeded()
+            self.queries += 1
+            self._results[key] = self.infer.map_query(list(variables), evidence=evidence)
+        return self._results[key]
+
+
+def find_changed_set(root, set, evidences, network, nodes, engine=None):
+    if engine is None:
+        engine = MapQueryEngine(network)
     query_set = []
     reduced_set = []
     for item in set:
@@ -25,70 +81,55 @@ def find_changed_set(root, set, evidences, network, nodes):
         else:
             query_set.append(item)
 
-
-    withEvidence = infer.map_query(query_set, evidence=evidences, show_progress=False)
-    standard = infer.map_query(query_set, show_progress=False)
+    try:
+        withEvidence = engine.map_query(query_set, evidence=evidences)
+        standard = engine.map_query(query_set)
+    except MapQueryBudgetExceeded:
+        return find_differing_set(root, set, evidences, network, nodes or {})
 
     for item in query_set:
             if withEvidence[item] != standard[item]:
                 reduced_set.append(item)
     return reduced_set
 
-def find_differing_set(root, set, evidences, network, nodes):
+def find_differing_set(root, set, evidences, network, divergences):
+    """
+    Keeps the evidences and all nodes that diverge noticeably more than the root
+    :param divergences: dict node name -> divergence, as computed in Scenario.compute_all_nodes
+    """
     reduced_set = []
-    parent_divergence = 0
-    for node in nodes:
-        if node['name'] == root.name:
-            parent_divergence = node['divergence']
-            break
+    parent_divergence = divergences.get(root.name, 0)
 
     for item in set:
-        if item in evidences.keys():
+        if item in evidences:
+            reduced_set.append(item)
+        elif (divergences.get(item, 0) - parent_divergence) > 0.03:
             reduced_set.append(item)
-        else:
-            item_divergence = 0
-            for node in nodes:
-                if node['name'] == item:
-                    item_divergence = node['divergence']
-                    break
-            if (item_divergence - parent_divergence) > 0.03:
-                reduced_set.append(item)
 
     return reduced_set
 
 # reduce markov blanket to smallest set of elements, that still gets the same classifications
-def find_smallest_set(root, set, evidences, network, nodes):
+def find_smallest_set(root, set, evidences, network, nodes, engine=None):
     #smallest set of an evidence is empty set
     if root.name in evidences: return []
 
-    infer = inference.VariableElimination(network)
+    if engine is None:
+        engine = MapQueryEngine(network)
     ancestors = [root]
     a = root
     while a.parent:
         a = a.parent
         ancestors.append(a)
-    ancestor_map = infer.map_query([x.name for x in ancestors], evidence=evidences, show_progress=False)
-    map = {}
-    for item in set:
-        if item in evidences.keys():
-            map[item] = evidences.get(item)
-        else:
-            map.update(infer.map_query([item], evidence=evidences, show_progress=False))
-
-    found = []
-    length = 1
-    while length < len(map) - 1:
-        for nodes in itertools.combinations(map, length):
-            e = {node: map.get(node) for node in nodes}
-            same = True
-            for x in ancestors:
-                result = infer.map_query([x.name], evidence=e, show_progress=False)
-                same = same and result[x.name] == ancestor_map[x.name]
-            if same:
-                found.append(nodes)
-
-        # if just one subset is found, return that one
-        if len(found) == 1: return list(found[0])
+
+    # if the budget runs out, the blanket gets reduced by divergence instead
+    try:
+        ancestor_map = engine.map_query([x.name for x in ancestors], evidence=evidences)
+        map = {}
+        for item in set:
+            if item in evidences.keys():
+                map[item] = evidences.get(item)
+            else:
+                map.update(engine.map_query([item], evidence=evidences))
 
         # sort nodes by amount of evidences
         def evidence_func(nodes):
@@ -98,99 +139,132 @@ def find_smallest_set(root, set, evidences, network, nodes):
                     i += 1
             return i
 
-        if len(found) > 1:
-            found.sort(reverse=True, key=evidence_func)
-            return list(found[0])
-        length += 1
+        length = 1
+        while length < len(map) - 1:
+            # of all working subsets of a length the one with most evidences (first in combination order) is
+            # chosen, so testing in that order allows to stop at the first subset that works
+            candidates = sorted(itertools.combinations(map, length), reverse=True, key=evidence_func)
+            for nodes in candidates:
+                e = {node: map.get(node) for node in nodes}
+                if all(engine.map_query([x.name], evidence=e)[x.name] == ancestor_map[x.name] for x in ancestors):
+                    return list(nodes)
+            length += 1
+    except MapQueryBudgetExceeded:
+        return find_differing_set(root, set, evidences, network, nodes or {})
 
     return set
 
 
-def add_markov_children(root, network, evidences=None, variables=None, subsetFunc=None, nodes=None):
-    blanket = network.get_markov_blanket(root.name)
+SUBSET_FUNCTIONS = {'differing': find_differing_set, 'changed': find_changed_set, 'smallest': find_smallest_set}
+
 
-    # find smallest set of nodes
-    cleanedBlanket = []
-    for node in blanket:
-        if node not in root.forbidden_set:
-            cleanedBlanket.append(node)
+def add_markov_children(root, network, evidences=None, variables=None, subsetFunc=None, nodes=None):
+    index = get_network_index(network)
 
-    small_blanket = cleanedBlanket
+    subset_evidence = {}
     if subsetFunc:
-        subset_evidence = {}
         for ev in evidences:
             subset_evidence[ev] = evidences[ev]
         for var in variables:
             subset_evidence[var] = variables[var]
-        small_blanket = subsetFunc(root, cleanedBlanket, subset_evidence, network, nodes)
 
-    # construct forbidden sets and add nodes
-    for node in small_blanket:
-        forbidden_set = [x for x in root.forbidden_set]  # copy by value
-        forbidden_set.append(node)
+    # depth first with an explicit stack, so deep networks don't hit the recursion limit
+    stack = [root]
+    while stack:
+        parent = stack.pop()
 
-        # check if it's a parent of root
-        if root.name in network.get_parents(node):
-            for parent in network.get_parents(node):
-                if parent not in forbidden_set:
-                    forbidden_set.append(parent)
+        # find smallest set of nodes
+        cleanedBlanket = [node for node in index.blanket[parent.name] if node not in parent.forbidden_set]
 
-        # check if it's a child of a parent of root
-        for c in network.get_children(node):
-            if root.name in network.get_parents(c):
-                if c not in forbidden_set:
-                    forbidden_set.append(c)
+        small_blanket = cleanedBlanket
+        if subsetFunc:
+            small_blanket = subsetFunc(parent, cleanedBlanket, subset_evidence, network, nodes)
 
+        # construct forbidden sets and add nodes
+        new_children = []
+        for node in small_blanket:
+            forbidden_set = set(parent.forbidden_set)  # copy by value
+            forbidden_set.add(node)
 
-        if not evidences or node not in evidences.keys():
-            sn = SupportNode(node, parent=root, forbidden_set=forbidden_set)
-            add_markov_children(sn, network, evidences, variables, subsetFunc, nodes)
-        else:
-            sn = SupportNode(node, parent=root)
+            # check if it's a parent of root
+            if parent.name in index.parent_sets[node]:
+                forbidden_set.update(index.parents[node])
+
+            # check if it's a child of a parent of root
+            for c in index.children[node]:
+                if parent.name in index.parent_sets[c]:
+                    forbidden_set.add(c)
+
+            if not evidences or node not in evidences:
+                sn = SupportNode(node, parent=parent, forbidden_set=forbidden_set)
+                new_children.append(sn)
+            else:
+                sn = SupportNode(node, parent=parent)
+        stack.extend(reversed(new_children))
 
 
 def deleteUseless(root, network, evidences, variables, most_relevant_nodes):
     # if root is evidence itself, don't delete
     evidence_list = []
     if most_relevant_nodes:
-        evidence_list = most_relevant_nodes
+        evidence_list = set(most_relevant_nodes)
     else:
         evidence_list = evidences.keys()
 
-    if root.name in evidence_list:
-        return 1
-
-    # if roots children are useless, delete them
-    for c in root.children:
-        deleteUseless(c, network, evidences, variables, most_relevant_nodes)
-
-    # if root is no evidence, but has no children, delete
-    if not root.children and root.name not in variables.keys():
-        root.parent = None
-
-
-def compute_explanation_of_target(network, evidences, variables, outcomes, most_relevant_nodes, states):
+    # post order: children are cleaned up before their parent is checked
+    stack = [(root, False)]
+    while stack:
+        node, visited = stack.pop()
+        if node.name in evidence_list:
+            continue
+        if not visited:
+            stack.append((node, True))
+            stack.extend((c, False) for c in reversed(node.children))
+        # if root is no evidence, but has no children, delete
+        elif not node.children and node.name not in variables.keys():
+            node.parent = None
+
+
+def _pre_order(root):
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
+
+
+def compute_explanation_of_target(network, evidences, variables, outcomes, most_relevant_nodes, states,
+                                  mode='differing', map_query_budget=None):
+    """
+    :param mode: how the markov blankets get reduced, one of SUBSET_FUNCTIONS
+    :param map_query_budget: maximum number of MAP queries for the "changed" and "smallest" modes
+    """
+    subsetFunc = SUBSET_FUNCTIONS[mode]
+    if mode != 'differing':
+        subsetFunc = functools.partial(subsetFunc, engine=MapQueryEngine(network, map_query_budget))
     rootNodes = []
     # create node list
     nodes = []
-    edges = []
+    edges = {}
+    divergences = {}
+    for state in states:
+        if 'divergence' in state and state['name'] not in divergences:
+            divergences[state['name']] = state['divergence']
 
     for outcome in outcomes:
-        outcome_node = SupportNode(outcome, forbidden_set=[outcome])
+        outcome_node = SupportNode(outcome, forbidden_set={outcome})
         add_markov_children(outcome_node, network, evidences=evidences, variables=variables,
-                            subsetFunc=find_differing_set, nodes=states)  #find_changed_set)  # , subsetFunc=find_smallest_set)
+                            subsetFunc=subsetFunc, nodes=divergences)
         deleteUseless(outcome_node, network, evidences, variables, most_relevant_nodes)
         rootNodes.append(outcome_node)
 
-        for node in PreOrderIter(outcome_node):
+        for node in _pre_order(outcome_node):
             nodes.append(node.name)
             for child in node.children:
-                edges.append([child.name, node.name])
+                edges[(child.name, node.name)] = None  # dict keeps the first occurrence order
 
     nodes = list(set(nodes))
-    reduced_edges = []
-    [reduced_edges.append(edge) for edge in edges if edge not in reduced_edges]
 
-    obj_edges = [{"source": edge[0], "target": edge[1]} for edge in reduced_edges]
+    obj_edges = [{"source": edge[0], "target": edge[1]} for edge in edges]
 
     return {"nodes": nodes, "edges": obj_edges}
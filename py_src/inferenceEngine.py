@@ -0,0 +1,319 @@
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+from opt_einsum import contract_expression, get_symbol
+
+import py_src.metrics as metrics
+import py_src.resultCache as resultCache
+
+"""
+Exact inference with elimination plans that are compiled once per network and query signature.
+A signature is the tuple of query variables and the set of evidence variables; the evidence values
+only change which CPT slices are fed into the compiled contraction. Each plan only contracts the requisite part
+of the network: barren nodes, evidence d-separated from the query and factors cut off by the evidence are pruned.
+"""
+
+MAX_PLANS = 1024
+# evidence sets contracted together by query_batch; smaller batches are padded to the next power of two,
+# so every plan compiles at most a few batch expressions
+BATCH_SIZE = 256
+
+
+class QueryPlan:
+
+    def __init__(self, engine, variables, evidence_vars):
+        self.variables = list(variables)
+        self.evidence_vars = frozenset(evidence_vars)
+
+        # evidence d-separated from the query variables by the other evidence doesn't change the result,
+        # it is summed out like an unobserved variable
+        requisite = engine.observed_reachable(variables, evidence_vars)
+        self.requisite_evidence = frozenset(requisite)
+        self.ignored_evidence = self.evidence_vars - self.requisite_evidence
+
+        # barren nodes: only the ancestors of query and requisite evidence variables influence the result
+        relevant = set()
+        stack = list(variables) + list(requisite)
+        while stack:
+            node = stack.pop()
+            if node not in relevant:
+                relevant.add(node)
+                stack.extend(engine.parents[node])
+
+        # evidence is absorbed by slicing the CPTs; fully observed CPTs and factors that are no longer connected
+        # to a query variable through unobserved variables only contribute a constant
+        candidates = []
+        component = {}
+
+        def find(var):
+            while component[var] != var:
+                component[var] = component[component[var]]
+                var = component[var]
+            return var
+
+        for node in engine.order:
+            if node not in relevant:
+                continue
+            cpd = engine.cpds[node]
+            free = [var for var in cpd.variables if var not in requisite]
+            if not free:
+                continue
+            for var in free:
+                component.setdefault(var, var)
+            for var in free[1:]:
+                component[find(var)] = find(free[0])
+            candidates.append((cpd, free))
+        connected = {find(var) for var in variables}
+
+        self.factors = []  # (cpd values, evidence variables with their axis) per factor
+        symbols = {}
+        operands = []
+        for cpd, free in candidates:
+            if find(free[0]) not in connected:
+                continue
+            observed = [(axis, var) for axis, var in enumerate(cpd.variables) if var in requisite]
+            self.factors.append((cpd.values, observed))
+            term = ''.join(symbols.setdefault(var, get_symbol(len(symbols))) for var in free)
+            operands.append((term, tuple(engine.cardinality[var] for var in free)))
+
+        output = ''.join(symbols.setdefault(var, get_symbol(len(symbols))) for var in variables)
+        subscripts = ','.join(term for term, _ in operands) + '->' + output
+        self.expression = contract_expression(subscripts, *[shape for _, shape in operands], optimize='greedy')
+
+        self.operands = operands
+        self.output = output
+        self.batch_symbol = get_symbol(len(symbols))
+        self._batch_expressions = {}  # batch size -> compiled expression with a leading batch axis
+
+    def check(self, engine, evidence):
+        # unknown states of ignored evidence raise the same KeyError as those of requisite evidence
+        for var in self.ignored_evidence:
+            engine.state_numbers[var][evidence[var]]
+
+    def run(self, engine, evidence):
+        self.check(engine, evidence)
+        operands = []
+        for values, observed in self.factors:
+            if observed:
+                indexer = [slice(None)] * values.ndim
+                for axis, var in observed:
+                    indexer[axis] = engine.state_numbers[var][evidence[var]]
+                values = values[tuple(indexer)]
+            operands.append(values)
+        return self.expression(*operands)
+
+    def run_batch(self, engine, evidences):
+        """
+        Contracts the plan for many evidence sets over the same evidence variables at once: the observed CPT
+        slices of all sets are stacked along a batch axis that every sliced factor and the result share
+        :param evidences: list of dicts variable -> observed state name, all with the plan's evidence variables
+        :return: ndarray with the batch axis first, then one axis per query variable
+        """
+        batch = len(evidences)
+        if self.ignored_evidence:
+            for evidence in evidences:
+                self.check(engine, evidence)
+        operands = []
+        terms = []
+        for (values, observed), (term, _) in zip(self.factors, self.operands):
+            if observed:
+                axes = [axis for axis, _ in observed]
+                states = tuple(np.fromiter((engine.state_numbers[var][evidence[var]] for evidence in evidences),
+                                           dtype=np.intp, count=batch) for _, var in observed)
+                values = np.moveaxis(values, axes, range(len(axes)))[states]
+                term = self.batch_symbol + term
+            operands.append(values)
+            terms.append(term)
+
+        if not any(self.batch_symbol in term for term in terms):
+            # the evidence only touches fully observed CPTs, all sets give the same distribution
+            result = self.expression(*operands)
+            return np.broadcast_to(result, (batch,) + result.shape)
+
+        expression = self._batch_expressions.get(batch)
+        if expression is None:
+            subscripts = ','.join(terms) + '->' + self.batch_symbol + self.output
+            expression = contract_expression(subscripts, *[operand.shape for operand in operands], optimize='greedy')
+            self._batch_expressions[batch] = expression
+        return expression(*operands)
+
+
+class InferenceEngine:
+    """
+    Answers the queries of all modules for one network, caching an elimination plan per
+    (query variables, evidence variables)
+    """
+
+    def __init__(self, model, max_plans=MAX_PLANS):
+        self.cpds = {cpd.variable: cpd for cpd in model.get_cpds()}
+        self.parents = {node: list(model.get_parents(node)) for node in model.nodes()}
+        self.children = {node: list(model.get_children(node)) for node in model.nodes()}
+        self.order = list(model.nodes())
+        self.state_names = {var: list(cpd.state_names[var]) for var, cpd in self.cpds.items()}
+        self.state_numbers = {var: {state: i for i, state in enumerate(states)}
+                              for var, states in self.state_names.items()}
+        self.cardinality = {var: len(states) for var, states in self.state_names.items()}
+        self.max_plans = max_plans
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+        # identifies the network in the shared result cache; networks from the network cache carry their content
+        # hash, so equal networks share results
+        self.key = getattr(model, 'content_hash', None) or uuid.uuid4().hex
+
+    def plan(self, variables, evidence_vars):
+        key = (tuple(variables), frozenset(evidence_vars))
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                return plan
+        plan = QueryPlan(self, variables, evidence_vars)
+        with self._lock:
+            self._plans[key] = plan
+            if len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+        return plan
+
+    def reachable(self, sources, observed):
+        """
+        Bayes-ball: finds the variables that an active trail from the sources reaches. The unobserved ones are
+        the variables d-connected to the sources given the observed variables; given the reached observed ones,
+        the sources are d-separated from all other observed variables.
+        :param sources: variables to start from, not observed
+        :param observed: observed variables
+        :return: set of the reached variables, including the sources
+        """
+        observed = set(observed)
+        reached = set()
+        visited = set()
+        stack = [(node, True) for node in sources]  # (node, the ball comes from a child)
+        while stack:
+            node, from_child = stack.pop()
+            if (node, from_child) in visited:
+                continue
+            visited.add((node, from_child))
+            reached.add(node)
+            if node in observed:
+                if not from_child:
+                    # an observed common effect connects its parents
+                    stack.extend((parent, True) for parent in self.parents[node])
+                continue
+            if from_child:
+                stack.extend((parent, True) for parent in self.parents[node])
+            stack.extend((child, False) for child in self.children[node])
+        return reached
+
+    def observed_reachable(self, sources, observed):
+        """
+        :return: set of the observed variables reached from the sources, see reachable
+        """
+        return self.reachable(sources, observed) & set(observed)
+
+    def query(self, variables, evidence=None):
+        """
+        Same as VariableElimination.query with a joint result
+        :param variables: list of query variables
+        :param evidence: dict variable -> observed state name
+        :return: normalized DiscreteFactor over the variables, in the given order
+        """
+        from pgmpy.factors.discrete import DiscreteFactor
+
+        evidence = evidence or {}
+        common_vars = set(evidence).intersection(variables)
+        if common_vars:
+            raise ValueError(f"Can't have the same variables in both `variables` and `evidence`. Found in both: {common_vars}")
+
+        key = ('query', self.key, tuple(variables), resultCache.evidence_key(evidence))
+        values = self._cached(key, evidence)
+        if values is None:
+            metrics.count_queries()
+            # float32 CPTs (see py_src.compactCpds) still give float64 results
+            values = self.plan(variables, evidence.keys()).run(self, evidence).astype(np.float64, copy=False)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values = values / values.sum()
+            values.flags.writeable = False
+            self._store(key, evidence, values)
+        # DiscreteFactor copies the values, the cached array stays unchanged
+        return DiscreteFactor(list(variables), values.shape, values,
+                              state_names={var: self.state_names[var] for var in variables})
+
+    def query_batch(self, variables, evidences):
+        """
+        Answers the same query for many evidence sets that observe the same variables
+        :param variables: list of query variables
+        :param evidences: list of dicts variable -> observed state name, all with the same keys
+        :return: ndarray with one normalized joint distribution over the variables per evidence set
+        """
+        if not evidences:
+            return np.zeros((0,) + tuple(self.cardinality[var] for var in variables))
+        evidence_vars = evidences[0].keys()
+        common_vars = set(evidence_vars).intersection(variables)
+        if common_vars:
+            raise ValueError(f"Can't have the same variables in both `variables` and `evidence`. Found in both: {common_vars}")
+        metrics.count_queries(len(evidences))
+
+        plan = self.plan(variables, evidence_vars)
+        parts = []
+        for start in range(0, len(evidences), BATCH_SIZE):
+            chunk = evidences[start:start + BATCH_SIZE]
+            size = 1 << (len(chunk) - 1).bit_length()
+            padded = chunk + [chunk[-1]] * (size - len(chunk))
+            parts.append(plan.run_batch(self, padded)[:len(chunk)])
+        values = np.concatenate(parts).astype(np.float64, copy=False)
+        axes = tuple(range(1, values.ndim))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return values / values.sum(axis=axes, keepdims=True)
+
+    def map_query(self, variables, evidence=None):
+        """
+        Same as VariableElimination.map_query
+        :return: dict variable -> most probable state name of the joint distribution
+        """
+        if not variables:
+            return {}
+        evidence = evidence or {}
+        key = ('map_query', self.key, tuple(variables), resultCache.evidence_key(evidence))
+        assignment = self._cached(key, evidence)
+        if assignment is None:
+            metrics.count_queries()
+            values = self.plan(variables, evidence.keys()).run(self, evidence)
+            assignment = np.unravel_index(np.argmax(values), values.shape)
+            assignment = {var: self.state_names[var][i] for var, i in zip(variables, assignment)}
+            self._store(key, evidence, assignment)
+        return dict(assignment)
+
+    def _cached(self, key, evidence):
+        if not evidence:
+            return resultCache.pinned.get(key)
+        return resultCache.cache.get(key)
+
+    def _store(self, key, evidence, result):
+        if not evidence:
+            resultCache.pinned.put(key, result)
+        else:
+            resultCache.cache.put(key, result)
+
+
+_engines = weakref.WeakKeyDictionary()
+
+
+def clear_results():
+    """
+    Forgets all cached inference results, with and without evidence; elimination plans are kept
+    """
+    resultCache.clear()
+
+
+def get_engine(model):
+    """
+    :param model: pgmpy BayesianNetwork
+    :return: the InferenceEngine shared by all queries on this model
+    """
+    engine = _engines.get(model)
+    if engine is None:
+        engine = InferenceEngine(model)
+        _engines[model] = engine
+    return engine
@@ -0,0 +1,168 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import py_src.serializer as serializer
+
+"""
+Background jobs for long running calculations. Jobs run on a thread pool of the web worker that received
+them, their status, progress and result are kept in a SQLite file, so any web worker can answer a poll.
+Unfinished jobs carry the process that owns them and a heartbeat; a job whose process died or stopped beating
+is marked as failed when it is polled or when a worker starts.
+"""
+
+COLUMNS = {'owner': 'TEXT', 'host': 'TEXT', 'pid': 'INTEGER', 'heartbeat': 'REAL'}  # added to older job tables
+
+
+class JobQueue:
+
+    def __init__(self, database, workers=2, retention=3600, on_error=None, stale_after=60, heartbeat_interval=None,
+                 clock=time.time):
+        """
+        :param database: path of the SQLite file shared by all web workers
+        :param workers: number of jobs running at the same time in this process
+        :param retention: seconds a finished job is kept before it gets deleted
+        :param on_error: called without arguments inside the except block of a failed job, e.g. to report it
+        :param stale_after: seconds without a heartbeat after which an unfinished job counts as lost
+        :param heartbeat_interval: seconds between the heartbeats of unfinished jobs, stale_after / 4 if None
+        :param clock: function returning the current time in seconds, stored in the job table
+        """
+        self.database = database
+        self.workers = workers
+        self.retention = retention
+        self.on_error = on_error if on_error is not None else traceback.print_exc
+        self.stale_after = stale_after
+        self.heartbeat_interval = heartbeat_interval if heartbeat_interval is not None else stale_after / 4
+        self.clock = clock
+        self.owner = uuid.uuid4().hex  # this queue, a restarted worker with a reused pid is another owner
+        self.host = socket.gethostname()
+        self._executor = None
+        self._active = 0  # unfinished jobs of this queue
+        self._heartbeat = None  # thread beating while jobs are unfinished
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT, status TEXT, '
+                               'progress REAL, result TEXT, error TEXT, created REAL, finished REAL)')
+            existing = {row[1] for row in connection.execute('PRAGMA table_info(jobs)')}
+            for column, columnType in COLUMNS.items():
+                if column not in existing:
+                    connection.execute(f'ALTER TABLE jobs ADD COLUMN {column} {columnType}')
+        self.fail_lost_jobs()
+
+    def _connect(self):
+        return sqlite3.connect(self.database, timeout=30)
+
+    def _update(self, job_id, **columns):
+        assignments = ', '.join(f'{column} = ?' for column in columns)
+        with self._connect() as connection:
+            connection.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', list(columns.values()) + [job_id])
+
+    def submit(self, kind, function, *args):
+        """
+        Queues function(*args, progress=callback), where callback takes the progress in percent
+        :param kind: name of the calculation, e.g. "calcOptions"
+        :return: id of the new job
+        """
+        job_id = uuid.uuid4().hex
+        now = self.clock()
+        with self._connect() as connection:
+            connection.execute('DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?', [now - self.retention])
+            connection.execute('INSERT INTO jobs (id, kind, status, progress, created, owner, host, pid, heartbeat) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               [job_id, kind, 'queued', 0, now, self.owner, self.host, os.getpid(), now])
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+            self._active += 1
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, name='job-heartbeat', daemon=True)
+                self._heartbeat.start()
+            self._executor.submit(self._run, job_id, function, args)
+        return job_id
+
+    def _run(self, job_id, function, args):
+        self._update(job_id, status='running', heartbeat=self.clock())
+
+        def progress(percent):
+            self._update(job_id, progress=float(percent))
+
+        try:
+            result = function(*args, progress=progress)
+            self._update(job_id, status='done', progress=100.0, result=serializer.dumps(result),
+                         finished=self.clock())
+        except Exception as e:
+            self.on_error()
+            self._update(job_id, status='failed', error=str(e), finished=self.clock())
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def _beat(self):
+        # queued and running jobs of this queue stay alive as long as this process does
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                if self._active == 0:
+                    self._heartbeat = None
+                    return
+            with self._connect() as connection:
+                connection.execute('UPDATE jobs SET heartbeat = ? WHERE owner = ? AND finished IS NULL',
+                                   [self.clock(), self.owner])
+
+    def _lost(self, owner, host, pid, heartbeat, now):
+        if heartbeat is None or heartbeat < now - self.stale_after:
+            return True
+        if host == self.host and pid == os.getpid():
+            return owner != self.owner  # submitted by an earlier process with the same pid
+        if host == self.host and pid is not None:
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return True  # the owning worker exited
+            except PermissionError:
+                pass
+        return False
+
+    def fail_lost_jobs(self, job_id=None):
+        """
+        Marks unfinished jobs whose worker died or restarted as failed
+        :param job_id: only check this job, all unfinished jobs if None
+        """
+        now = self.clock()
+        query = 'SELECT id, owner, host, pid, heartbeat FROM jobs WHERE finished IS NULL'
+        with self._connect() as connection:
+            if job_id is None:
+                rows = connection.execute(query).fetchall()
+            else:
+                rows = connection.execute(query + ' AND id = ?', [job_id]).fetchall()
+            for lost_id, owner, host, pid, heartbeat in rows:
+                if self._lost(owner, host, pid, heartbeat, now):
+                    connection.execute("UPDATE jobs SET status = 'failed', error = ?, finished = ? "
+                                       "WHERE id = ? AND finished IS NULL",
+                                       ['the worker running the job stopped, please submit it again', now, lost_id])
+
+    def get(self, job_id):
+        """
+        :param job_id: id returned by submit
+        :return: dict with status, progress and, when done, the result or the error; None for unknown jobs
+        """
+        self.fail_lost_jobs(job_id)
+        with self._connect() as connection:
+            row = connection.execute('SELECT kind, status, progress, result, error FROM jobs WHERE id = ?',
+                                     [job_id]).fetchone()
+        if row is None:
+            return None
+        kind, status, progress, result, error = row
+        job = {'jobId': job_id, 'kind': kind, 'status': status, 'progress': progress}
+        if status == 'done':
+            job['result'] = json.loads(result)
+        if status == 'failed':
+            job['error'] = error
+        return job
@@ -0,0 +1,351 @@
+import numpy as np
+
+import py_src.metrics as metrics
+
+"""
+Junction tree (clique tree) inference on the CPTs of a pgmpy BayesianNetwork.
+The tree is built once per network; a calibration propagates one evidence set through it
+(Shafer-Shenoy message passing), after which all single node marginals can be read off together.
+"""
+
+# cliques with more entries than this make the junction tree intractable, callers fall back to variable elimination
+MAX_CLIQUE_ENTRIES = 2 ** 20
+
+
+def _expand(values, variables, position, ndim):
+    # transposes and reshapes a factor so that it broadcasts against arrays over all variables
+    axes = sorted(range(len(variables)), key=lambda a: position[variables[a]])
+    shape = [1] * ndim
+    for a in axes:
+        shape[position[variables[a]]] = values.shape[a]
+    return np.transpose(values, axes).reshape(shape)
+
+
+def _contract(factors, out_vars):
+    """
+    Multiplies the factors and sums out all variables not in out_vars
+    :param factors: list of (variables, ndarray) tuples, one array axis per variable
+    :param out_vars: variables of the resulting array, in this order
+    :return: ndarray over out_vars
+    """
+    all_vars = list(dict.fromkeys(v for variables, _ in factors for v in variables))
+    position = {v: i for i, v in enumerate(all_vars)}
+
+    result = None
+    owned = False
+    for variables, values in factors:
+        expanded = _expand(values, variables, position, len(all_vars))
+        if result is None:
+            result = expanded
+        elif owned and np.broadcast_shapes(result.shape, expanded.shape) == result.shape:
+            result *= expanded
+        else:
+            result = result * expanded
+            owned = True
+
+    summed = tuple(i for i, v in enumerate(all_vars) if v not in out_vars)
+    if summed:
+        result = result.sum(axis=summed)
+    remaining = [v for v in all_vars if v in out_vars]
+    return np.transpose(result, [remaining.index(v) for v in out_vars])
+
+
+def _find_cliques(adjacency, cardinality):
+    """
+    Triangulates the moral graph by greedy min-fill elimination (ties broken by clique weight)
+    :param adjacency: dict node -> set of neighbours in the moral graph
+    :param cardinality: dict node -> number of states
+    :return: list of maximal cliques as tuples of nodes
+    """
+    adjacency = {node: set(neighbours) for node, neighbours in adjacency.items()}
+
+    def score(node):
+        neighbours = list(adjacency[node])
+        fill = 0
+        for i, a in enumerate(neighbours):
+            for b in neighbours[i + 1:]:
+                if b not in adjacency[a]:
+                    fill += 1
+        weight = cardinality[node]
+        for n in neighbours:
+            weight *= cardinality[n]
+        return fill, weight
+
+    scores = {node: score(node) for node in adjacency}
+    cliques = []
+    while scores:
+        node = min(scores, key=lambda n: (scores[n], str(n)))
+        neighbours = adjacency[node]
+        cliques.append(frozenset(neighbours | {node}))
+        for a in neighbours:
+            adjacency[a] |= neighbours - {a}
+            adjacency[a].discard(node)
+        del adjacency[node]
+        del scores[node]
+        # fill edges only change the scores of nodes at most two steps away
+        touched = set(neighbours)
+        for a in neighbours:
+            touched |= adjacency[a]
+        for n in touched:
+            scores[n] = score(n)
+
+    maximal = []
+    for clique in sorted(cliques, key=len, reverse=True):
+        if not any(clique <= other for other in maximal):
+            maximal.append(clique)
+    return maximal
+
+
+class JunctionTree:
+
+    def __init__(self, model, max_clique_entries=MAX_CLIQUE_ENTRIES):
+        self.variables = list(model.nodes())
+        self.state_names = {}
+        self.cardinality = {}
+        for cpd in model.get_cpds():
+            var = cpd.variable
+            self.state_names[var] = list(cpd.state_names[var])
+            self.cardinality[var] = len(self.state_names[var])
+
+        # moralize
+        adjacency = {var: set() for var in self.variables}
+        families = {}
+        for cpd in model.get_cpds():
+            family = list(cpd.variables)
+            families[cpd.variable] = family
+            for a in family:
+                for b in family:
+                    if a != b:
+                        adjacency[a].add(b)
+
+        cliques = _find_cliques(adjacency, self.cardinality)
+        # keep a deterministic variable order inside each clique
+        order = {var: i for i, var in enumerate(self.variables)}
+        self.cliques = [sorted(clique, key=order.get) for clique in cliques]
+        self.clique_sets = [set(clique) for clique in self.cliques]
+        self.clique_entries = [int(np.prod([self.cardinality[v] for v in clique])) for clique in self.cliques]
+        self.tractable = max(self.clique_entries) <= max_clique_entries
+
+        self._build_tree()
+
+        # every variable is read off (and its evidence entered) in the smallest clique containing it
+        self.home = {}
+        for var in self.variables:
+            candidates = [i for i, clique in enumerate(self.clique_sets) if var in clique]
+            self.home[var] = min(candidates, key=lambda i: self.clique_entries[i])
+
+        self.potentials = None
+        if self.tractable:
+            self.potentials = [np.ones([self.cardinality[v] for v in clique]) for clique in self.cliques]
+            for cpd in model.get_cpds():
+                family = set(families[cpd.variable])
+                i = min((i for i, clique in enumerate(self.clique_sets) if family <= clique),
+                        key=lambda i: self.clique_entries[i])
+                self.potentials[i] = _contract([(self.cliques[i], self.potentials[i]),
+                                                (list(cpd.variables), cpd.values)], self.cliques[i])
+        self._prior = None  # calibration without evidence, see calibrate
+
+    def _build_tree(self):
+        # maximum weight spanning tree over the sepset sizes (Kruskal), empty sepsets join unconnected parts
+        n = len(self.cliques)
+        pairs = []
+        for i in range(n):
+            for j in range(i + 1, n):
+                pairs.append((len(self.clique_sets[i] & self.clique_sets[j]), i, j))
+        pairs.sort(key=lambda p: (-p[0], p[1], p[2]))
+
+        component = list(range(n))
+
+        def find(i):
+            while component[i] != i:
+                component[i] = component[component[i]]
+                i = component[i]
+            return i
+
+        self.neighbours = [[] for _ in range(n)]
+        for _, i, j in pairs:
+            a, b = find(i), find(j)
+            if a != b:
+                component[a] = b
+                self.neighbours[i].append(j)
+                self.neighbours[j].append(i)
+
+        self.sepsets = {}
+        for i in range(n):
+            for j in self.neighbours[i]:
+                self.sepsets[(i, j)] = [v for v in self.cliques[i] if v in self.clique_sets[j]]
+
+        # breadth first order from clique 0, used for the collect and distribute passes
+        self.parent = [None] * n
+        self.order = [0]
+        seen = {0}
+        for i in self.order:
+            for j in self.neighbours[i]:
+                if j not in seen:
+                    seen.add(j)
+                    self.parent[j] = i
+                    self.order.append(j)
+
+        # depth first numbering, the subtree below clique i consists of the cliques numbered first[i] to last[i]
+        children = [[] for _ in range(n)]
+        for j in self.order[1:]:
+            children[self.parent[j]].append(j)
+        self.first = [0] * n
+        self.last = [0] * n
+        number = 0
+        stack = [(0, False)]
+        while stack:
+            i, finished = stack.pop()
+            if finished:
+                self.last[i] = number - 1
+                continue
+            self.first[i] = number
+            number += 1
+            stack.append((i, True))
+            stack.extend((j, False) for j in children[i])
+
+    def message_depends_on(self, i, j, cliques):
+        """
+        :return: whether the message from clique i to its neighbour j depends on the findings of any of the cliques
+        """
+        if self.parent[i] == j:
+            # a message to the parent collects the subtree below i
+            return any(self.first[i] <= self.first[h] <= self.last[i] for h in cliques)
+        return not all(self.first[j] <= self.first[h] <= self.last[j] for h in cliques)
+
+    def clear_prior(self):
+        # the next calibration without evidence is computed again
+        self._prior = None
+
+    def calibrate(self, evidence=None, previous=None):
+        """
+        Propagates the evidence through the tree
+        :param evidence: dict variable -> observed state name
+        :param previous: optional Calibration of this tree for other evidence; its messages that don't depend on
+        the changed findings are reused, so a few changed findings only update the messages leading away from them
+        :return: Calibration object to read marginals from
+        """
+        if not evidence:
+            # the calibration without evidence is the same for every request and kept with the tree
+            if self._prior is None:
+                metrics.count_queries()
+                self._prior = Calibration(self, {})
+            return self._prior
+        metrics.count_queries()
+        return Calibration(self, evidence, previous)
+
+
+class Calibration:
+
+    def __init__(self, tree, evidence, previous=None):
+        self.tree = tree
+        self.evidence = evidence
+        self._previous = previous
+        if previous is not None:
+            changed = set(evidence).symmetric_difference(previous.evidence) | \
+                      {var for var in evidence if var in previous.evidence and previous.evidence[var] != evidence[var]}
+            self._changed = {tree.home[var] for var in changed}
+        # findings are kept per variable in their home clique
+        self.findings = [[] for _ in tree.cliques]
+        for var, state in evidence.items():
+            finding = np.zeros(tree.cardinality[var])
+            finding[tree.state_names[var].index(state)] = 1
+            self.findings[tree.home[var]].append((var, finding))
+
+        self.messages = {}
+        self.log_scales = {}
+        self._beliefs = {}
+        for i in reversed(tree.order[1:]):
+            if not self._reuse(i, tree.parent[i]):
+                self._send(i, tree.parent[i])
+        for i in tree.order:
+            children = [j for j in tree.neighbours[i] if tree.parent[j] == i and not self._reuse(i, j)]
+            if len(children) > 1:
+                self._distribute(i, children)
+            else:
+                for j in children:
+                    self._send(i, j)
+        self._previous = None  # don't keep a chain of old calibrations alive
+
+    def _reuse(self, i, j):
+        # takes the message i -> j from the previous calibration if it doesn't depend on the changed findings
+        if self._previous is None or self.tree.message_depends_on(i, j, self._changed):
+            return False
+        self.messages[(i, j)] = self._previous.messages[(i, j)]
+        self.log_scales[(i, j)] = self._previous.log_scales[(i, j)]
+        return True
+
+    def _incoming(self, i, exclude=None):
+        return [(self.tree.sepsets[(k, i)], self.messages[(k, i)])
+                for k in self.tree.neighbours[i] if k != exclude]
+
+    def _local(self, i, exclude=None):
+        return [(self.tree.cliques[i], self.tree.potentials[i])] + \
+               [([var], finding) for var, finding in self.findings[i] if var != exclude]
+
+    def _send(self, i, j):
+        message = _contract(self._local(i) + self._incoming(i, exclude=j), self.tree.sepsets[(i, j)])
+        self._store(i, j, message, sum(self.log_scales[(k, i)] for k in self.tree.neighbours[i] if k != j))
+
+    def _distribute(self, i, children):
+        # divide the reverse message out of the clique belief instead of multiplying all other messages
+        # again for every child; where the reverse message is zero the quotient is undefined, so those
+        # messages are computed directly
+        belief = self.belief(i)
+        belief_log_scale = sum(self.log_scales[(k, i)] for k in self.tree.neighbours[i])
+        for j in children:
+            reverse = self.messages[(j, i)]
+            if not reverse.all():
+                self._send(i, j)
+                continue
+            sepset_marginal = _contract([(self.tree.cliques[i], belief)], self.tree.sepsets[(i, j)])
+            self._store(i, j, sepset_marginal / reverse, belief_log_scale - self.log_scales[(j, i)])
+
+    def _store(self, i, j, message, log_scale):
+        # messages are rescaled to sum to one, the log of the scale is kept to recover the true values
+        total = message.sum()
+        if total > 0:
+            message = message / total
+            log_scale += np.log(total)
+        else:
+            log_scale = -np.inf
+        self.messages[(i, j)] = message
+        self.log_scales[(i, j)] = log_scale
+
+    def belief(self, i):
+        """
+        :param i: clique index
+        :return: unnormalized belief of the clique, with one axis per clique variable
+        """
+        if i not in self._beliefs:
+            self._beliefs[i] = _contract(self._local(i) + self._incoming(i), self.tree.cliques[i])
+        return self._beliefs[i]
+
+    def marginal(self, var):
+        """
+        :param var: variable name
+        :return: normalized distribution of the variable given the evidence
+        """
+        i = self.tree.home[var]
+        belief = self.belief(i)
+        axis = self.tree.cliques[i].index(var)
+        distribution = belief.sum(axis=tuple(a for a in range(belief.ndim) if a != axis))
+        return distribution / distribution.sum()
+
+    def log_probability(self):
+        """
+        :return: natural logarithm of the probability of the evidence
+        """
+        with np.errstate(divide='ignore'):
+            return np.log(self.belief(0).sum()) + sum(self.log_scales[(k, 0)] for k in self.tree.neighbours[0])
+
+    def retract(self, var):
+        """
+        Fast retraction of one evidence variable: since Shafer-Shenoy messages into a clique never contain
+        the findings of that clique, leaving out the variable's own finding there yields P(var, evidence without var)
+        :param var: evidence variable
+        :return: (values, log_scale), the unnormalized distribution is values * exp(log_scale)
+        """
+        i = self.tree.home[var]
+        values = _contract(self._local(i, exclude=var) + self._incoming(i), [var])
+        return values, sum(self.log_scales[(k, i)] for k in self.tree.neighbours[i])
@@ -0,0 +1,179 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+Low overhead timing of request stages and counting of inference queries. Every web worker keeps its own
+histograms; a stage costs two perf_counter calls and one locked update.
+"""
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_local = threading.local()
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._series = {}  # label value -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, label, value):
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self, name, label_name, help_text):
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        with self._lock:
+            series = {label: (list(counts), total, count) for label, (counts, total, count) in self._series.items()}
+        for label, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{{label_name}="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{label_name}="{label}",le="+Inf"}} {count}')
+            lines.append(f'{name}_sum{{{label_name}="{label}"}} {total}')
+            lines.append(f'{name}_count{{{label_name}="{label}"}} {count}')
+        return lines
+
+
+class RequestMetrics:
+    """
+    Stage durations and inference query count of the request handled by the current thread
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}  # stage -> seconds, in order of first use
+        self.queries = 0
+
+
+request_durations = Histogram()
+stage_durations = Histogram()
+_queries_total = 0
+_queries_lock = threading.Lock()
+startup_durations = {}  # startup stage -> seconds, in order of the stages
+_startup_last = time.perf_counter()
+
+
+def start_request():
+    _local.request = RequestMetrics()
+    return _local.request
+
+
+def current():
+    """
+    :return: RequestMetrics of the current thread, None outside of a request
+    """
+    return getattr(_local, 'request', None)
+
+
+def finish_request(endpoint):
+    """
+    Records the total duration of the current request
+    :param endpoint: label of the request duration histogram
+    :return: the finished RequestMetrics or None
+    """
+    request = current()
+    if request is None:
+        return None
+    _local.request = None
+    request_durations.observe(endpoint, time.perf_counter() - request.start)
+    return request
+
+
+@contextmanager
+def stage(name):
+    """
+    Times the enclosed block as stage name of the current request and in the stage histogram
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        stage_durations.observe(name, duration)
+        request = current()
+        if request is not None:
+            request.stages[name] = request.stages.get(name, 0) + duration
+
+
+def timed(name):
+    """
+    Decorator timing every call of the function as stage name
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def startup_mark(name):
+    """
+    Records the time since the previous mark, or since this module was imported, as startup stage name
+    """
+    global _startup_last
+    now = time.perf_counter()
+    startup_durations[name] = startup_durations.get(name, 0) + now - _startup_last
+    _startup_last = now
+
+
+def startup_report():
+    """
+    :return: one line with the duration of every startup stage in seconds
+    """
+    return "startup " + " ".join(f"{name}={seconds:.3f}s" for name, seconds in startup_durations.items())
+
+
+def count_queries(n=1):
+    global _queries_total
+    request = current()
+    if request is not None:
+        request.queries += n
+    with _queries_lock:
+        _queries_total += n
+
+
+def server_timing(request):
+    """
+    :param request: finished RequestMetrics
+    :return: value of the Server-Timing header, durations in milliseconds
+    """
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in request.stages.items()]
+    entries.append(f"total;dur={(time.perf_counter() - request.start) * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def render(extra=()):
+    """
+    :param extra: further (name, type, help, value) samples, e.g. cache statistics
+    :return: all metrics of this worker in the Prometheus text format
+    """
+    lines = request_durations.render('doctorbn_request_duration_seconds', 'endpoint',
+                                     'Duration of requests per endpoint')
+    lines += stage_durations.render('doctorbn_stage_duration_seconds', 'stage',
+                                    'Duration of calculation stages')
+    lines += ["# HELP doctorbn_inference_queries_total Inference queries issued",
+              "# TYPE doctorbn_inference_queries_total counter",
+              f"doctorbn_inference_queries_total {_queries_total}"]
+    if startup_durations:
+        lines += ["# HELP doctorbn_startup_seconds Duration of the startup stages of this worker",
+                  "# TYPE doctorbn_startup_seconds gauge"]
+        lines += [f'doctorbn_startup_seconds{{stage="{name}"}} {seconds}' for name, seconds in startup_durations.items()]
+    for name, kind, help_text, value in extra:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,89 @@
+import os
+
+from py_src.Network import Network
+import py_src.networkBlob as networkBlob
+
+"""
+Directory of memory mapped network files shared by all web and pool workers of a machine. The file name is
+the network hash, so the directory itself is the index from hash to segment. Workers map the CPTs read-only
+and share one copy in the page cache; the files survive worker restarts, so a restarted worker skips parsing.
+Mapped files are trusted like parsed networks, so the directory must belong to the server user and must not be
+writable by anybody else.
+"""
+
+SUFFIX = '.dbnmap'
+
+
+class ModelStore:
+
+    def __init__(self, directory, max_bytes):
+        """
+        :param directory: directory of the mapped files, created with mode 0700 if missing
+        :param max_bytes: the least recently written files are deleted above this total size
+        :raises PermissionError: if the directory belongs to another user or others can write to it
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        status = os.stat(directory)
+        if not _owned(status) or status.st_mode & 0o022:
+            raise PermissionError(f"model store {directory} must belong to this user and be writable only by it")
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def load(self, key, fileString, fileFormat):
+        """
+        :param key: network hash
+        :return: Network with memory mapped CPTs, or None if the network is not in the store or the file was
+        written by another user
+        """
+        try:
+            if not _owned(os.stat(self.path(key))):
+                return None  # rewritten by save, replacing the file
+            return Network(fileString, fileFormat, mapped=self.path(key))
+        except OSError:
+            return None  # not written yet or deleted meanwhile
+
+    def save(self, key, network):
+        """
+        Writes a network to the store and returns it reloaded with memory mapped CPTs
+        :param key: network hash
+        :param network: parsed network
+        :return: the mapped network, or the given one if it could not be written
+        """
+        try:
+            networkBlob.write_mapped(network, self.path(key))
+        except OSError:
+            return network
+        self._prune(keep=key)
+        return self.load(key, network.fileString, network.fileFormat) or network
+
+    def _prune(self, keep):
+        # deleting a file is safe for workers still mapping it, the mapping stays valid until it is closed
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX) and name != keep + SUFFIX:
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        try:
+            total += os.path.getsize(self.path(keep))
+        except OSError:
+            pass
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+            except OSError:
+                pass
+
+
+def _owned(status):
+    # ownership can't be checked on platforms without user ids
+    return not hasattr(os, 'getuid') or status.st_uid == os.getuid()
@@ -0,0 +1,139 @@
+import io
+import json
+import os
+
+import numpy as np
+
+"""
+Compiled binary form of a parsed network, stored next to the network text at upload. Loading it only builds
+the pgmpy objects from the stored CPT arrays, without running the NET or BIF parser.
+The blob is an npz archive: one array per CPT plus a JSON header with nodes, edges, states and labels.
+The same content can be written uncompressed to a file whose CPTs are memory mapped by all workers.
+"""
+
+# stored in the header, blobs of another version are ignored and the network text is parsed instead
+VERSION = 1
+
+MAGIC = b'DBNMAP1\0'
+ALIGNMENT = 64
+
+
+class IncompatibleBlob(ValueError):
+    pass
+
+
+def _header(network):
+    model = network.model
+    return {'version': VERSION,
+            'nodes': list(model.nodes()),
+            'edges': [list(edge) for edge in model.edges()],
+            'cpds': [{'variables': list(cpd.variables),
+                      'state_names': {var: list(cpd.state_names[var]) for var in cpd.variables}}
+                     for cpd in model.get_cpds()],
+            'states': [[node, list(states)] for node, states in network.states.items()],
+            'network_edges': [list(edge) for edge in network.edges],
+            'labels': [[node, label] for node, label in network.labels.items()]}
+
+
+def _build(header, arrays):
+    """
+    :param header: dict written by _header
+    :param arrays: CPT values in the order of header["cpds"]
+    :return: (model, states, edges, labels) as set on py_src.Network.Network
+    """
+    from pgmpy.factors.discrete import TabularCPD
+    from pgmpy.models import BayesianNetwork
+
+    if header.get('version') != VERSION:
+        raise IncompatibleBlob(f"network blob version {header.get('version')}, expected {VERSION}")
+
+    model = BayesianNetwork()
+    model.add_nodes_from(header['nodes'])
+    model.add_edges_from(header['edges'])
+    cpds = []
+    for description, values in zip(header['cpds'], arrays):
+        variable, evidence = description['variables'][0], description['variables'][1:]
+        cpd = TabularCPD(variable, values.shape[0], values.reshape(values.shape[0], -1),
+                         evidence=evidence or None, evidence_card=list(values.shape[1:]) or None,
+                         state_names=description['state_names'])
+        cpd.values = values  # TabularCPD copies its input, keep the given (possibly memory mapped) array instead
+        cpds.append(cpd)
+    model.add_cpds(*cpds)
+
+    states = {node: node_states for node, node_states in header['states']}
+    labels = {node: label for node, label in header['labels']}
+    return model, states, header['network_edges'], labels
+
+
+def compile_network(network):
+    """
+    :param network: py_src.Network.Network object
+    :return: blob as bytes
+    """
+    arrays = {f'cpd{i}': cpd.values for i, cpd in enumerate(network.model.get_cpds())}
+    arrays['header'] = np.frombuffer(json.dumps(_header(network)).encode(), dtype=np.uint8)
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def load_network(blob):
+    """
+    :param blob: bytes returned by compile_network
+    :return: (model, states, edges, labels) as set on py_src.Network.Network
+    """
+    with np.load(io.BytesIO(blob), allow_pickle=False) as archive:
+        header = json.loads(archive['header'].tobytes().decode())
+        return _build(header, [archive[f'cpd{i}'] for i in range(len(header['cpds']))])
+
+
+def write_mapped(network, path):
+    """
+    Writes the network uncompressed, so that its CPTs can be memory mapped by read_mapped.
+    Layout: magic, header length (8 bytes), JSON header, then the CPT arrays at 64 byte aligned offsets.
+    The file is written under a temporary name and renamed, readers never see a partial file.
+    :param network: py_src.Network.Network object
+    :param path: file to write
+    """
+    values = [np.ascontiguousarray(cpd.values) for cpd in network.model.get_cpds()]
+    header = _header(network)
+    header['arrays'] = []
+    offset = 0
+    for array in values:
+        header['arrays'].append({'offset': offset, 'shape': list(array.shape), 'dtype': array.dtype.str})
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    encoded = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(encoded)) // ALIGNMENT) * ALIGNMENT
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(MAGIC + len(encoded).to_bytes(8, 'little') + encoded)
+        for array, description in zip(values, header['arrays']):
+            f.seek(data_start + description['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(temporary, path)
+
+
+def read_mapped(path):
+    """
+    Maps a file written by write_mapped read-only; the CPT values are views into the mapping, so all
+    processes reading the same file share one copy in the page cache
+    :param path: file to read
+    :return: (model, states, edges, labels) as set on py_src.Network.Network
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise IncompatibleBlob(f"{path} is not a mapped network file")
+        length = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(length).decode())
+    data_start = -(-(len(MAGIC) + 8 + length) // ALIGNMENT) * ALIGNMENT
+
+    mapping = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = []
+    for description in header['arrays']:
+        dtype = np.dtype(description['dtype'])
+        start = data_start + description['offset']
+        nbytes = int(np.prod(description['shape'])) * dtype.itemsize
+        arrays.append(mapping[start:start + nbytes].view(dtype).reshape(description['shape']))
+    return _build(header, arrays)
@@ -0,0 +1,168 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import py_src.compactCpds as compactCpds
+from py_src.Network import Network
+from py_src.modelStore import ModelStore
+
+"""
+In-process LRU cache of parsed networks, keyed by a hash of the file content and format,
+so that the pgmpy readers only run once per network and worker. Cached networks are compacted
+(see py_src.compactCpds) and evicted when their estimated memory exceeds the budget.
+"""
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def network_hash(fileString, fileFormat):
+    """
+    Computes the content hash used as cache key of a network
+    :param fileString: the network file as string
+    :param fileFormat: "net" or "bif"
+    :return: hex digest of the hash
+    """
+    h = hashlib.sha256()
+    h.update(fileFormat.encode())
+    h.update(b'\0')
+    h.update(fileString.encode())
+    return h.hexdigest()
+
+
+def estimate_size(network):
+    """
+    Estimates the memory used by a parsed network in bytes, including its junction tree once it is built;
+    memory mapped CPTs are shared with the other workers and not counted
+    :param network: py_src.Network.Network object
+    :return: approximate size in bytes
+    """
+    return compactCpds.memory_report(network)['total_bytes']
+
+
+class NetworkCache:
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size_bytes = 0
+        self._entries = OrderedDict()  # hash -> (network, size)
+        self._lock = threading.Lock()
+        self.store = None  # optional ModelStore shared by the workers of this machine
+        self.float32 = False  # store all CPTs as float32, not only the deterministic ones
+
+    def get(self, fileString, fileFormat, compiled=None):
+        """
+        Returns the parsed network for the given file, parsing it only if it is not cached yet.
+        The returned network is shared between requests and must not be modified. Its CPTs are compacted,
+        compile blobs from a network parsed with py_src.Network.Network instead.
+        :param fileString: the network file as string
+        :param fileFormat: "net" or "bif"
+        :param compiled: optional blob of py_src.networkBlob, loaded instead of parsing the file
+        :return: py_src.Network.Network object
+        """
+        key = network_hash(fileString, fileFormat)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # parse outside the lock, so other networks can still be served meanwhile
+        network = self.store.load(key, fileString, fileFormat) if self.store is not None else None
+        if network is None:
+            network = Network(fileString, fileFormat, compiled)
+            if self.store is not None:
+                network = self.store.save(key, network)  # the store keeps the CPTs at full precision
+        # only this worker's copy is compacted; mapped CPTs are shared and stay as they are
+        compactCpds.compact(network, self.float32)
+        network.hash = key
+        network.model.content_hash = key  # lets the inference engines share cached results of equal networks
+        self.put(key, network)
+        return network
+
+    def lookup(self, key):
+        """
+        :param key: network hash
+        :return: the cached network or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, network):
+        size = estimate_size(network)
+        with self._lock:
+            if key in self._entries:
+                self.size_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (network, size)
+            self._refresh_sizes()
+            self._evict()
+
+    def _refresh_sizes(self):
+        # junction trees are built after a network was cached, count them before deciding what to evict
+        for entry_key, (network, _) in self._entries.items():
+            self._entries[entry_key] = (network, estimate_size(network))
+        self.size_bytes = sum(size for _, size in self._entries.values())
+
+    def _evict(self):
+        # always keep the most recently used network, even if it alone exceeds the limit
+        while self.size_bytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.size_bytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'size_bytes': self.size_bytes, 'max_bytes': self.max_bytes}
+
+    def memory_report(self):
+        """
+        :return: dict network hash -> py_src.compactCpds.memory_report of the network, least recently used first
+        """
+        with self._lock:
+            self._refresh_sizes()
+            return {key: compactCpds.memory_report(network) for key, (network, _) in self._entries.items()}
+
+
+cache = NetworkCache()
+
+
+def configure(max_bytes, float32=False):
+    """
+    Sets the memory limit of the shared network cache and evicts networks if necessary
+    :param max_bytes: maximum approximate size of all cached networks in bytes
+    :param float32: store all CPTs of networks loaded afterwards as float32
+    """
+    with cache._lock:
+        cache.max_bytes = max_bytes
+        cache.float32 = float32
+        cache._refresh_sizes()
+        cache._evict()
+
+
+def configure_store(directory, max_bytes):
+    """
+    Shares the CPTs of all networks between the workers of this machine through memory mapped files
+    :param directory: directory of the mapped files, None or empty disables the store
+    :param max_bytes: maximum total size of the mapped files
+    """
+    cache.store = ModelStore(directory, max_bytes) if directory else None
+
+
+def get_network(fileString, fileFormat, compiled=None):
+    return cache.get(fileString, fileFormat, compiled)
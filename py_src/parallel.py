@@ -0,0 +1,117 @@
+import math
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import py_src.metrics as metrics
+import py_src.networkCache as networkCache
+
+"""
+Opt-in process pool for batches of independent inference queries of one request.
+Workers keep their own network cache, so a network is sent to a worker only the first time it needs it.
+"""
+
+_workers = 0
+_executor = None
+_lock = threading.Lock()
+
+
+def configure(workers):
+    """
+    Sets the number of worker processes, 0 or 1 runs all queries in the calling process
+    :param workers: number of worker processes
+    """
+    global _workers, _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+        _workers = workers
+
+
+def enabled():
+    return _workers > 1
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            # spawned workers don't inherit locks held by threads of the web worker
+            store = networkCache.cache.store
+            _executor = ProcessPoolExecutor(max_workers=_workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_initialize_worker,
+                                            initargs=((store.directory, store.max_bytes) if store else (None, 0))
+                                            + (networkCache.cache.float32,))
+        return _executor
+
+
+def _reset_executor(executor):
+    # a pool whose worker died (e.g. killed for using too much memory) rejects all further work
+    global _executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _initialize_worker(directory, max_bytes, float32):
+    # pool workers load networks like the web worker, so both compute with the same CPTs
+    networkCache.configure_store(directory, max_bytes)
+    networkCache.cache.float32 = float32
+
+
+def _run_chunk(key, source, function, chunk):
+    network = networkCache.cache.lookup(key)
+    if network is None:
+        if source is None:
+            return None  # not loaded in this worker yet, the caller resends the chunk with the network source
+        network = networkCache.get_network(*source)
+    # count the queries of the chunk, so that they can be added to the calling request
+    request = metrics.start_request()
+    return [function(network, *arguments) for arguments in chunk], request.queries
+
+
+def map_queries(network, function, arguments):
+    """
+    Calls function(network, *args) for every args tuple of arguments
+    :param network: py_src.Network.Network object from the network cache
+    :param function: module level function, so it can be sent to the worker processes
+    :param arguments: list of argument tuples
+    :return: list of results, in the order of arguments
+    """
+    return list(imap_queries(network, function, arguments))
+
+
+def imap_queries(network, function, arguments):
+    """
+    Same as map_queries, but yields every result as soon as it and all results before it are available
+    """
+    arguments = list(arguments)
+    if not enabled() or len(arguments) < 2 or network.hash is None:
+        for args in arguments:
+            yield function(network, *args)
+        return
+
+    executor = _get_executor()
+    size = math.ceil(len(arguments) / (_workers * 4))
+    chunks = [arguments[i:i + size] for i in range(0, len(arguments), size)]
+    source = (network.fileString, network.fileFormat)
+    done = 0
+    try:
+        futures = [executor.submit(_run_chunk, network.hash, None, function, chunk) for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            chunk_results = future.result()
+            if chunk_results is None:
+                chunk_results = executor.submit(_run_chunk, network.hash, source, function, chunk).result()
+            chunk_results, queries = chunk_results
+            metrics.count_queries(queries)
+            done += 1
+            yield from chunk_results
+    except BrokenProcessPool:
+        # the next request starts a new pool, this one finishes its remaining chunks here
+        _reset_executor(executor)
+        for chunk in chunks[done:]:
+            for args in chunk:
+                yield function(network, *args)
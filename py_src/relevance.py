@@ -1,28 +1,42 @@
 import numpy
-from scipy.spatial import distance
-from pgmpy import inference
+import py_src.inferenceEngine as inferenceEngine
+import py_src.parallel as parallel
 import numpy as np
+import itertools
 import py_src.sumNDimensionalArray as sumND
 
 #calculates the dissimilarity of two probability distributions (states) of a node
 # == computes global relevance
 def compute_jensen_shannon_divergence(distribution_1, distribution_2):
-    dist1 = np.array(distribution_1).flatten()
-    dist2 = np.array(distribution_2).flatten()
-
-    p1 = []
-    p2 = []
-
-    for i in range(len(dist1)):
-        p1.append(float(dist1[i]))
-        p2.append(float(dist2[i]))
-
-    jen_shan = distance.jensenshannon(p1, p2)
-
-    if numpy.isnan(jen_shan):
-        jen_shan = 0
-
-    return jen_shan
+    return float(compute_jensen_shannon_divergences([np.ravel(distribution_1)], [np.ravel(distribution_2)])[0])
+
+#same as scipy.spatial.distance.jensenshannon for many pairs of distributions at once, 0 where it is undefined
+#distributions_1, distributions_2: 2-D arrays with one distribution per row, or lists of 1-D arrays of any length
+def compute_jensen_shannon_divergences(distributions_1, distributions_2):
+    p = pad_distributions(distributions_1)
+    q = pad_distributions(distributions_2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sum_p = p.sum(axis=1, keepdims=True)
+        sum_q = q.sum(axis=1, keepdims=True)
+        p = p / sum_p
+        q = q / sum_q
+        m = (p + q) / 2
+        # padded and impossible states contribute nothing, like in scipy.special.rel_entr
+        entropy = np.where(p > 0, p * np.log(p / m), 0) + np.where(q > 0, q * np.log(q / m), 0)
+        divergences = np.sqrt(entropy.sum(axis=1) / 2)
+    # distributions that sum to 0 can't be normalized
+    defined = (sum_p[:, 0] > 0) & (sum_q[:, 0] > 0) & np.isfinite(divergences)
+    return np.where(defined, divergences, 0.0)
+
+#stacks 1-D distributions into one row each, shorter ones padded with zeros
+def pad_distributions(distributions):
+    if isinstance(distributions, np.ndarray) and distributions.ndim == 2:
+        return distributions.astype(float, copy=False)
+    width = max((len(d) for d in distributions), default=0)
+    padded = np.zeros((len(distributions), width))
+    for row, distribution in zip(padded, distributions):
+        row[:len(distribution)] = distribution
+    return padded
 
 #compute local relevances
 def compute_relevancies_for_outcome_states(distribution_1, distribution_2):
@@ -38,29 +52,152 @@ def compute_relevancies_for_outcome_states(distribution_1, distribution_2):
 
     return all_rel_objects_for_current_node
 
-#nodes includes distributions with and without evidence for all nodes
-def get_influence_of_evidences_on_goals(network, evidences, goals, goalDirections):
-
-    all_relevance_of_evidence_objects = []  # list with all evidences and their relevances
-    infer = inference.VariableElimination(network)
-
-    sum_of_all_overall_relevancies = 0  # jennsen-shannon relevances of all targets together
-    distribution_all= infer.query(list(goals.keys()), evidence=evidences, show_progress=False)
+#distribution of the goals for all evidences and for every evidence left out, as arrays with one axis per goal
+def compute_leave_one_out_goal_distributions(network, evidences, goals):
+    model = network.model
+    junction_tree = network.get_junction_tree()
+    goal_configurations = int(np.prod([len(model.get_cpds(goal).state_names[goal]) for goal in goals]))
+    if junction_tree.tractable and goal_configurations <= len(evidences) + 1 \
+            and not any(goal in evidences for goal in goals):
+        return retract_goal_distributions(network, evidences, goals)
 
+    queries = []
     for e in evidences.keys():
-
-        rel_of_ev_obj = {"node_name": e, "overall_relevance":None, "relevancies":None}
-
         evidences_wo = {}
         for node in evidences.keys():
             if not node == e:
                 evidences_wo[node] = evidences[node]
+        queries.append((list(goals.keys()), evidences_wo))
+    queries.append((list(goals.keys()), evidences))
+
+    results = parallel.map_queries(network, query_goals, queries)
+    distributions_wo = dict(zip(evidences.keys(), results))
+    return results[-1], distributions_wo
+
+
+def query_goals(network, goals, evidence):
+    return inferenceEngine.get_engine(network.model).query(goals, evidence=evidence).values
+
+
+#fast retraction: one calibration per goal configuration gives the goal distributions for all left out evidences
+def retract_goal_distributions(network, evidences, goals):
+    junction_tree = network.get_junction_tree()
+    shape = [junction_tree.cardinality[goal] for goal in goals]
+    log_all = np.empty(shape)
+    log_wo = {e: np.empty(shape) for e in evidences}
+
+    configurations = list(itertools.product(*[range(n) for n in shape]))
+    results = parallel.map_queries(network, retract_goal_configuration,
+                                   [(evidences, goals, configuration) for configuration in configurations])
+    for configuration, (log_probability, log_probabilities_wo) in zip(configurations, results):
+        log_all[configuration] = log_probability
+        for e in evidences:
+            log_wo[e][configuration] = log_probabilities_wo[e]
+    return _normalize_log(log_all), {e: _normalize_log(log_wo[e]) for e in evidences}
+
+
+#same as retract_goal_distributions in this process, updating the calibrations of a previous call for other evidences
+def update_goal_distributions(network, evidences, goals, previous=None):
+    """
+    :param previous: dict goal configuration -> Calibration returned by a previous call with the same goals, or None
+    :return: (distribution with all evidences, dict evidence -> distribution without it, calibrations)
+    """
+    junction_tree = network.get_junction_tree()
+    shape = [junction_tree.cardinality[goal] for goal in goals]
+    log_all = np.empty(shape)
+    log_wo = {e: np.empty(shape) for e in evidences}
+    calibrations = {}
+    for configuration in itertools.product(*[range(n) for n in shape]):
+        calibrations[configuration], log_all[configuration], log_probabilities_wo = \
+            _retract(junction_tree, evidences, goals, configuration, (previous or {}).get(configuration))
+        for e in evidences:
+            log_wo[e][configuration] = log_probabilities_wo[e]
+    return _normalize_log(log_all), {e: _normalize_log(log_wo[e]) for e in evidences}, calibrations
+
+
+def _normalize_log(log_values):
+    with np.errstate(invalid='ignore'):
+        values = np.exp(log_values - np.max(log_values))
+        return values / values.sum()
+
+
+#log probabilities of one goal configuration with all evidences and with every evidence left out
+def retract_goal_configuration(network, evidences, goals, configuration):
+    _, log_probability, log_probabilities_wo = _retract(network.get_junction_tree(), evidences, goals, configuration)
+    return log_probability, log_probabilities_wo
+
+
+def _retract(junction_tree, evidences, goals, configuration, previous=None):
+    simEvidence = dict(evidences)
+    for goal, state in zip(goals, configuration):
+        simEvidence[goal] = junction_tree.state_names[goal][state]
+    calibrated = junction_tree.calibrate(simEvidence, previous)
+
+    log_probabilities_wo = {}
+    with np.errstate(divide='ignore'):
+        for e in evidences:
+            values, log_scale = calibrated.retract(e)
+            log_probabilities_wo[e] = np.log(values.sum()) + log_scale
+    return calibrated, calibrated.log_probability(), log_probabilities_wo
+
+
+#divergences below this are rounding noise of the retraction (about 1e-9 to 1e-8) and count as no influence
+RELEVANCE_TOLERANCE = 1e-7
+
+
+#evidences d-separated from the goals by the other evidences, leaving them out can't change the goal distribution
+def independent_evidences(network, evidences, goals):
+    if any(goal in evidences for goal in goals):
+        return set()
+    engine = inferenceEngine.get_engine(network.model)
+    independent = set()
+    for e in evidences:
+        others = [other for other in evidences if other != e]
+        if e not in engine.reachable(list(goals), others):
+            independent.add(e)
+    return independent
+
+
+#nodes includes distributions with and without evidence for all nodes
+#distributions: optional (distribution with all evidences, dict evidence -> distribution without it) computed before
+def get_influence_of_evidences_on_goals(network, evidences, goals, goalDirections, distributions=None):
 
-        distribution_wo = infer.query(list(goals.keys()), evidence=evidences_wo, show_progress=False)
+    all_relevance_of_evidence_objects = []  # list with all evidences and their relevances
+
+    sum_of_all_overall_relevancies = 0  # jennsen-shannon relevances of all targets together
+    if distributions is None:
+        distributions = compute_leave_one_out_goal_distributions(network, evidences, goals)
+    distribution_all, distributions_wo = distributions
+
+    evidence_names = list(evidences.keys())
+    if not evidence_names:
+        return all_relevance_of_evidence_objects
+    distribution_all = np.asarray(distribution_all)
+    # stack the distributions without every evidence along a leading axis, so all evidences are scored together
+    stacked_wo = np.stack([np.asarray(distributions_wo[e]) for e in evidence_names])
+
+    # global relevance
+    jensen_shannon_values = compute_jensen_shannon_divergences(
+        np.broadcast_to(distribution_all.reshape(1, -1), (len(evidence_names), distribution_all.size)),
+        stacked_wo.reshape(len(evidence_names), -1))
+    # exact zeros for evidence without influence, so rounding noise doesn't become a relevance share
+    independent = independent_evidences(network, evidences, goals)
+    for i, e in enumerate(evidence_names):
+        if e in independent:
+            jensen_shannon_values[i] = 0
+    jensen_shannon_values[jensen_shannon_values < RELEVANCE_TOLERANCE] = 0
+
+    # local relevance: marginals of every goal with all evidences and without every single evidence
+    goal_names = list(goals.keys())
+    marginals_all = sumND.getMarginalProbabilities(distribution_all)
+    marginals_wo = sumND.getMarginalProbabilities(stacked_wo, batchAxes=1)
+    option_nums = [list(network.model.get_cpds(goal).state_names[goal]).index(goals[goal]) for goal in goal_names]
+
+    for i, e in enumerate(evidence_names):
+
+        rel_of_ev_obj = {"node_name": e, "overall_relevance":None, "relevancies":None}
 
-        # global relevance
-        jensen_shannon_value = compute_jensen_shannon_divergence(distribution_all.values,
-                                                             distribution_wo.values)
+        jensen_shannon_value = float(jensen_shannon_values[i])
 
         rel_of_ev_obj["overall_relevance"] = jensen_shannon_value
         sum_of_all_overall_relevancies += jensen_shannon_value
@@ -69,17 +206,13 @@ def get_influence_of_evidences_on_goals(network, evidences, goals, goalDirection
         rel_of_ev_obj["relevancies"] = {} #compute_relevancies_for_outcome_states(distribution_all,
                                                              #distribution_wo)
 
-        for goal in goals.keys():
-            dimension = distribution_all.variables.index(goal)
-            distribution1 = sumND.getMarginalProbability(distribution_all.values, dimension)
-            optionNum1 = distribution_all.name_to_no[goal][goals[goal]]
-            value1 = distribution1[optionNum1]
-            dimension2 = distribution_wo.variables.index(goal)
-            distribution2 = sumND.getMarginalProbability(distribution_wo.values, dimension2)
-            optionNum2 = distribution_wo.name_to_no[goal][goals[goal]]
-            value2 = distribution2[optionNum2]
+        for dimension, goal in enumerate(goal_names):
+            optionNum = option_nums[dimension]
+            value1 = marginals_all[dimension][optionNum]
+            value2 = marginals_wo[dimension][i, optionNum]
 
-            rel_of_ev_obj["relevancies"][str(goal) + ": " + str(goals[goal])] = value1 - value2
+            rel_of_ev_obj["relevancies"][str(goal) + ": " + str(goals[goal])] = 0.0 if e in independent \
+                else value1 - value2
 
 
         # compute if recommendation changer
@@ -92,8 +225,11 @@ def get_influence_of_evidences_on_goals(network, evidences, goals, goalDirection
 
     # make global relevance to percentage
     for i in range(len(all_relevance_of_evidence_objects)):
-        new_overall_relevance_in_percentage = all_relevance_of_evidence_objects[i]["overall_relevance"] / \
-                                              sum_of_all_overall_relevancies
+        if sum_of_all_overall_relevancies > 0:
+            new_overall_relevance_in_percentage = all_relevance_of_evidence_objects[i]["overall_relevance"] / \
+                                                  sum_of_all_overall_relevancies
+        else:
+            new_overall_relevance_in_percentage = 0  # no evidence has any influence on the goals
 
         if numpy.isnan(new_overall_relevance_in_percentage):
             new_overall_relevance_in_percentage = 0
@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import OrderedDict
+
+"""
+Cache of inference results shared by all endpoints of a worker, keyed by network hash, query and evidence.
+Entries are evicted least recently used first when the memory limit is reached, and expire after a TTL.
+Evidence-free results are asked for by almost every request, they are kept in a separate, smaller cache
+without TTL, so that results with evidence can't push them out (see InferenceEngine.query).
+"""
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL = 3600
+DEFAULT_PINNED_MAX_BYTES = 16 * 1024 * 1024
+# bookkeeping per entry on top of the result arrays: key tuple, OrderedDict node, expiry
+ENTRY_OVERHEAD = 256
+
+
+def evidence_key(evidence):
+    """
+    :param evidence: dict variable -> observed state name
+    :return: hashable form that does not depend on the order of the dict
+    """
+    return tuple(sorted(evidence.items()))
+
+
+def result_size(result):
+    nbytes = getattr(result, 'nbytes', None)
+    return ENTRY_OVERHEAD + (nbytes if nbytes is not None else 64 * len(result))
+
+
+class ResultCache:
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.size_bytes = 0
+        self._entries = OrderedDict()  # key -> (result, size, expiry time)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: the cached result or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[2] < time.monotonic():
+                del self._entries[key]
+                self.size_bytes -= entry[1]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result):
+        """
+        :param result: read-only ndarray or dict, callers must not modify it afterwards
+        """
+        if self.max_bytes <= 0:
+            return
+        size = result_size(result)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size_bytes -= old[1]
+            self._entries[key] = (result, size, time.monotonic() + self.ttl)
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.size_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'expirations': self.expirations, 'entries': len(self._entries),
+                    'size_bytes': self.size_bytes, 'max_bytes': self.max_bytes}
+
+
+cache = ResultCache()
+pinned = ResultCache(DEFAULT_PINNED_MAX_BYTES, ttl=float('inf'))  # results without evidence
+
+
+def configure(max_bytes, ttl, pinned_max_bytes=DEFAULT_PINNED_MAX_BYTES):
+    """
+    :param max_bytes: memory limit of the cached results, 0 disables the cache
+    :param ttl: seconds after which a result is recomputed
+    :param pinned_max_bytes: memory limit of the cached results without evidence, 0 disables them
+    """
+    for results, limit, expiry in ((cache, max_bytes, ttl), (pinned, pinned_max_bytes, float('inf'))):
+        with results._lock:
+            results.max_bytes = limit
+            results.ttl = expiry
+        if limit <= 0:
+            results.clear()
+
+
+def clear():
+    cache.clear()
+    pinned.clear()
+
+
+def stats():
+    """
+    :return: stats of the cache with the stats of the pinned results under "pinned"
+    """
+    return dict(cache.stats(), pinned=pinned.stats())
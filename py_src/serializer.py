@@ -0,0 +1,92 @@
+import gzip
+import json
+
+import numpy as np
+
+try:
+    import brotli
+except ImportError:  # installed with requirements.txt; without it responses fall back to gzip
+    brotli = None
+
+"""
+JSON serialization of Scenario results. NumPy arrays and scalars are converted in one pass, floats can be
+rounded to a fixed number of digits, and node lists can be sent in a compact columnar layout.
+"""
+
+# the node attributes holding one value per state
+DISTRIBUTION_KEYS = ('distribution', 'distribution_wo_evidence')
+
+
+def to_builtin(obj, precision=None):
+    """
+    Converts NumPy arrays and scalars in a nested structure of dicts, lists and tuples to Python objects
+    :param obj: structure to convert
+    :param precision: number of decimal digits floats are rounded to, None keeps them unchanged
+    :return: structure containing only JSON serializable Python objects
+    """
+    if isinstance(obj, dict):
+        return {key if isinstance(key, (str, int)) else to_builtin(key): to_builtin(value, precision)
+                for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_builtin(value, precision) for value in obj]
+    if isinstance(obj, np.ndarray):
+        if precision is not None and obj.dtype.kind == 'f':
+            obj = np.round(obj, precision)
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if precision is not None and isinstance(obj, float):
+        return round(obj, precision)
+    return obj
+
+
+def columnar_nodes(nodes):
+    """
+    Packs a node list of Scenario.compute_all_nodes into one array per attribute. The distributions of all
+    nodes are concatenated, the states of node i are at offsets[i]:offsets[i + 1]. Evidence nodes have no
+    distributions, their divergence is null.
+    :param nodes: list of node dicts
+    :return: dict of arrays
+    """
+    offsets = [0]
+    for node in nodes:
+        offsets.append(offsets[-1] + len(node.get('stateNames', ())))
+    columns = {'name': [node['name'] for node in nodes],
+               'state': [node['state'] for node in nodes],
+               'probability': np.array([node['probability'] for node in nodes], dtype=float),
+               'divergence': [node.get('divergence') for node in nodes],
+               'stateNames': [list(node['stateNames'].values()) if 'stateNames' in node else None for node in nodes],
+               'offsets': offsets}
+    for key in DISTRIBUTION_KEYS:
+        values = [node[key] for node in nodes if key in node]
+        columns[key] = np.concatenate(values) if values else np.zeros(0)
+    return columns
+
+
+def dumps(obj, precision=None, columnar=False):
+    """
+    :param obj: Scenario result, usually a dict
+    :param precision: number of decimal digits floats are rounded to, None keeps them unchanged
+    :param columnar: send the "nodes" entry of a result dict in the columnar layout
+    :return: compact JSON string
+    """
+    if columnar and isinstance(obj, dict) and isinstance(obj.get('nodes'), list):
+        obj = dict(obj, nodes=columnar_nodes(obj['nodes']))
+    return json.dumps(to_builtin(obj, precision), separators=(',', ':'), allow_nan=True)
+
+
+def compress(body, accept_encoding, min_size=1024):
+    """
+    Compresses a response body with the best encoding accepted by the client
+    :param body: bytes
+    :param accept_encoding: werkzeug Accept object of the Accept-Encoding header
+    :param min_size: smaller bodies are sent as they are
+    :return: (body, content encoding or None)
+    """
+    if len(body) < min_size:
+        return body, None
+    if brotli is not None and accept_encoding['br']:
+        return brotli.compress(body, quality=5), 'br'
+    if accept_encoding['gzip']:
+        return gzip.compress(body, compresslevel=6), 'gzip'
+    return body, None
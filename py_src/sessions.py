@@ -0,0 +1,216 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+import py_src.inferenceEngine as inferenceEngine
+import py_src.relevance as relevance
+from py_src.Scenario import node_results
+
+"""
+Evidence sessions: a case that is built up one finding at a time. The session data (network source, goals,
+options and the current evidences) is kept in a SQLite file, so any web worker can continue a session.
+Every worker keeps the calibrated junction trees of its recently used sessions in memory and moves them to the
+new evidences incrementally: only the messages leading away from changed findings are recomputed, and only the
+nodes d-connected to a changed finding get new results.
+"""
+
+# relevance is retracted from one calibration per goal configuration, these are kept with the session up to this many
+MAX_GOAL_CONFIGURATIONS = 64
+# approximate size of one node result
+NODE_RESULT_BYTES = 512
+
+
+class Session:
+    """
+    Calibrated inference state of one session in this worker
+    """
+
+    def __init__(self, network, goals):
+        self.network = network
+        self.goals = list(goals)
+        self.evidences = None  # evidences the state was computed for
+        self.nodes = {}  # node -> node_result, for unobserved nodes
+        self.calibrated = None
+        self.goal_calibrations = None  # goal configuration -> Calibration with the goals set to it
+        self.distributions = None  # (goal distribution, dict evidence -> goal distribution without it)
+        self.lock = threading.Lock()
+
+    def update(self, evidences):
+        """
+        Moves the state to the given evidences
+        :param evidences: dict node -> observed state name
+        :return: False if the junction tree is intractable and the results have to be computed without the session
+        """
+        junction_tree = self.network.get_junction_tree()
+        if not junction_tree.tractable:
+            return False
+        if evidences == self.evidences:
+            return True
+
+        if self.evidences is None:
+            affected = set(self.network.states)
+        else:
+            changed = {var for var in set(evidences) | set(self.evidences)
+                       if evidences.get(var) != self.evidences.get(var)}
+            unchanged = [var for var in evidences if var not in changed]
+            # marginals of nodes d-separated from all changed findings stay the same
+            affected = inferenceEngine.get_engine(self.network.model).reachable(changed, unchanged)
+
+        self.calibrated = junction_tree.calibrate(evidences, previous=self.calibrated)
+        calibrated_wo_evidence = junction_tree.calibrate()
+        nodes = {node: self.nodes[node] for node in self.network.states
+                 if node not in evidences and node not in affected and node in self.nodes}
+        changed_nodes = [node for node in self.network.states if node not in evidences and node not in nodes]
+        results = node_results(changed_nodes, [self.calibrated.marginal(node) for node in changed_nodes],
+                               [calibrated_wo_evidence.marginal(node) for node in changed_nodes],
+                               [dict(enumerate(junction_tree.state_names[node])) for node in changed_nodes])
+        nodes.update(zip(changed_nodes, results))
+        self.nodes = nodes
+
+        configurations = int(np.prod([junction_tree.cardinality[goal] for goal in self.goals]))
+        if configurations <= MAX_GOAL_CONFIGURATIONS and not any(goal in evidences for goal in self.goals):
+            distribution, distributions_wo, self.goal_calibrations = \
+                relevance.update_goal_distributions(self.network, evidences, self.goals, self.goal_calibrations)
+            self.distributions = (distribution, distributions_wo)
+        else:
+            self.goal_calibrations = None
+            self.distributions = None  # left to relevance.compute_leave_one_out_goal_distributions
+        self.evidences = dict(evidences)
+        return True
+
+    def results(self):
+        """
+        :return: (node results in the order of Scenario.compute_all_nodes, goal distributions or None)
+        """
+        nodes = [{"name": node, "state": self.evidences[node], "probability": 1}
+                 for node in self.network.states if node in self.evidences]
+        nodes += [self.nodes[node] for node in self.network.states if node not in self.evidences]
+        return nodes, self.distributions
+
+    def size(self):
+        """
+        :return: approximate memory used by the state in bytes, messages shared between calibrations counted twice
+        """
+        calibrations = [self.calibrated] + list((self.goal_calibrations or {}).values())
+        size = NODE_RESULT_BYTES * len(self.nodes)
+        for calibrated in calibrations:
+            if calibrated is not None:
+                size += sum(message.nbytes for message in calibrated.messages.values())
+                size += sum(belief.nbytes for belief in calibrated._beliefs.values())
+        return size
+
+
+class SessionStore:
+
+    def __init__(self, database, max_bytes, idle_seconds):
+        """
+        :param database: path of the SQLite file shared by all web workers
+        :param max_bytes: memory limit of the session states of this worker
+        :param idle_seconds: sessions unused for this time are deleted
+        """
+        self.database = database
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.evictions = 0
+        self._states = OrderedDict()  # session id -> (Session, size, last use)
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT, used REAL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.database, timeout=30)
+
+    def create(self, data):
+        """
+        :param data: JSON serializable session data
+        :return: id of the new session
+        """
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute('DELETE FROM sessions WHERE used < ?', [now - self.idle_seconds])
+            connection.execute('INSERT INTO sessions (id, data, used) VALUES (?, ?, ?)',
+                               [session_id, json.dumps(data), now])
+        return session_id
+
+    def get(self, session_id):
+        """
+        :return: the session data, None for unknown or expired sessions
+        """
+        return self.update(session_id, lambda data: data)
+
+    def update(self, session_id, change):
+        """
+        Changes the data of a session; concurrent changes of the same session are applied one after the other
+        :param change: function taking the session data and returning the new data
+        :return: the new session data, None for unknown or expired sessions
+        """
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT data FROM sessions WHERE id = ? AND used >= ?',
+                                     [session_id, now - self.idle_seconds]).fetchone()
+            if row is None:
+                connection.rollback()
+                return None
+            data = change(json.loads(row[0]))
+            connection.execute('UPDATE sessions SET data = ?, used = ? WHERE id = ?', [json.dumps(data), now, session_id])
+            connection.commit()
+            return data
+        finally:
+            connection.close()
+
+    def delete(self, session_id):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM sessions WHERE id = ?', [session_id])
+        with self._lock:
+            self._states.pop(session_id, None)
+
+    def evaluate(self, session_id, network, goals, evidences):
+        """
+        Brings the state of a session in this worker to the given evidences, building it if necessary
+        :param network: py_src.Network.Network of the session
+        :param goals: list of goal nodes
+        :param evidences: dict node -> observed state name, including the options
+        :return: see Session.results, None if the network is too large for the junction tree
+        """
+        with self._lock:
+            entry = self._states.get(session_id)
+        session = entry[0] if entry is not None else None
+        # a network that was evicted from the network cache and loaded again has a new junction tree
+        if session is None or session.network is not network or session.goals != list(goals):
+            session = Session(network, goals)
+        with session.lock:
+            if not session.update(evidences):
+                return None
+            results = session.results()
+            size = session.size()
+
+        now = time.monotonic()
+        with self._lock:
+            self._states.pop(session_id, None)
+            self._states[session_id] = (session, size, now)
+            self._evict(now)
+        return results
+
+    def _evict(self, now):
+        total = sum(size for _, size, _ in self._states.values())
+        for session_id, (_, size, used) in list(self._states.items()):
+            # always keep the most recently used session, even if it alone exceeds the limit
+            if len(self._states) <= 1 or (total <= self.max_bytes and used >= now - self.idle_seconds):
+                break
+            del self._states[session_id]
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._states), 'size_bytes': sum(size for _, size, _ in self._states.values()),
+                    'max_bytes': self.max_bytes, 'evictions': self.evictions}
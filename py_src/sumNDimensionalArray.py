@@ -13,13 +13,31 @@ def getMarginalProbability(array, axis):
     :param axis:     dimension of the variable of interest
     :return:        List containing the m
     """
-    array = np.array(array)
-    dim = array.ndim
-    for i in range(dim):
-        if dim-i-1 != axis:
-            array = array.sum(dim-i-1)
-            if axis > dim-i-1:
-                axis -= 1
-    return array
+    array = np.asarray(array)
+    return array.sum(axis=tuple(a for a in range(array.ndim) if a != axis))
 
 
+def getMarginalProbabilities(array, batchAxes=0):
+    """
+    Calculates the marginal probabilities of all variables of the array together. The axes are split in halves
+    and every half is summed out once, so the marginals share most of the work instead of reducing the whole
+    array once per variable.
+    :param array:   n-dimensional array
+    :param batchAxes: number of leading axes that are kept in every marginal, e.g. one per evidence set
+    :return:        list with the marginal of every non-batch axis, in axis order
+    """
+    array = np.asarray(array)
+    marginals = []
+
+    def split(values, axes):
+        # values has the batch axes followed by the given variable axes
+        if len(axes) == 1:
+            marginals.append(values)
+            return
+        half = len(axes) // 2
+        split(values.sum(axis=tuple(range(batchAxes + half, batchAxes + len(axes)))), axes[:half])
+        split(values.sum(axis=tuple(range(batchAxes, batchAxes + half))), axes[half:])
+
+    if array.ndim > batchAxes:
+        split(array, list(range(batchAxes, array.ndim)))
+    return marginals
@@ -1,7 +1,29 @@
 import os
+import tempfile
 
 SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL'].replace("postgres", "postgresql") #can't use the original one, because support for postgres:// in URI got removed (now: postgresql)
 SECRET_KEY = os.environ.get('SECRET_KEY')
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+NETWORK_CACHE_MAX_BYTES = int(os.environ.get('NETWORK_CACHE_MAX_BYTES', 256 * 1024 * 1024))  # memory limit of the parsed network cache per worker, including junction trees
+CPT_FLOAT32 = int(os.environ.get('CPT_FLOAT32', 0))  # 1 stores all CPTs as float32 (relative error about 1e-7), deterministic CPTs always are
+EXPLANATION_MAP_QUERY_BUDGET = int(os.environ.get('EXPLANATION_MAP_QUERY_BUDGET', 2000))  # MAP queries per explanation in the "changed" and "smallest" modes
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', 0))  # processes for independent queries of a request, 0 disables
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))  # background jobs running at the same time per worker
+JOB_DATABASE = os.environ.get('JOB_DATABASE', os.path.join(tempfile.gettempdir(), 'doctorbn_jobs.sqlite'))  # job status store shared by all workers
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', 3600))  # finished jobs are deleted after this time
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', 60))  # unfinished jobs without a heartbeat for this time are marked as failed
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESSION_MIN_BYTES', 1024))  # smaller responses are sent uncompressed
+MODEL_STORE_DIR = os.environ.get('MODEL_STORE_DIR', '')  # memory mapped networks shared by all workers, a private directory of the server user, empty disables
+MODEL_STORE_MAX_BYTES = int(os.environ.get('MODEL_STORE_MAX_BYTES', 1024 * 1024 * 1024))  # size limit of the mapped network files
+APPROXIMATE_SAMPLES = int(os.environ.get('APPROXIMATE_SAMPLES', 20000))  # sample budget of approximate inference
+APPROXIMATE_ABOVE_CLIQUE_ENTRIES = int(os.environ.get('APPROXIMATE_ABOVE_CLIQUE_ENTRIES', 2 ** 27))  # larger networks are approximated unless a request asks for exact inference, 0 disables
+APPROXIMATE_MAX_SAMPLES = int(os.environ.get('APPROXIMATE_MAX_SAMPLES', 1000000))  # upper limit of the sample budget a request can ask for
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))  # memory limit of the cached inference results per worker, 0 disables
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get('RESULT_CACHE_TTL_SECONDS', 3600))  # cached inference results are recomputed after this time
+RESULT_CACHE_PINNED_MAX_BYTES = int(os.environ.get('RESULT_CACHE_PINNED_MAX_BYTES', 16 * 1024 * 1024))  # memory limit of the cached results without evidence, kept without TTL, 0 disables
+SESSION_DATABASE = os.environ.get('SESSION_DATABASE', os.path.join(tempfile.gettempdir(), 'doctorbn_sessions.sqlite'))  # evidence session store shared by all workers
+SESSION_MAX_BYTES = int(os.environ.get('SESSION_MAX_BYTES', 256 * 1024 * 1024))  # memory limit of the calibrated session states per worker
+SESSION_IDLE_SECONDS = int(os.environ.get('SESSION_IDLE_SECONDS', 1800))  # sessions unused for this time are deleted
+PRELOAD_NETWORKS = os.environ.get('PRELOAD_NETWORKS', '')  # comma separated names of networks loaded at startup, "*" for all; add --preload to GUNICORN_CMD_ARGS to load them once before forking the workers
 # NETWORK_FOLDER = './Networks'
 
@@ -0,0 +1,31 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import py_src.cohort as cohort
+from py_src.Network import Network
+from networks import SyntheticNetwork
+
+"""
+Cohort scoring with invalid patient rows.
+"""
+
+
+def test_invalid_rows_do_not_fail_their_group():
+    synthetic = SyntheticNetwork(8, seed=1)
+    network = Network(synthetic.to_string('bif'), 'bif')
+    evidences = [{'n0': 's0'}, {'n0': 'bogus'}, {'n0': 's1', 'unknown': 'x'}]
+    results = cohort.evaluate_cohort(network, evidences, ['n2'], {'n7': 's0'}, {'n7': 'max'})
+    assert 'error' not in results[0] and 'optionResults' in results[0] and 'likelyResults' in results[0]
+    assert results[1]['error'].startswith("Unknown state 'bogus' of node 'n0'")
+    assert results[2]['error'] == "Unknown node 'unknown'"
+
+
+def test_unknown_csv_columns_are_dropped():
+    evidences = cohort.read_csv("id,n0,n1\n1,s0,\n2,s1,s0\n")
+    kept, unknown = cohort.drop_unknown_columns(evidences, {'n0': [], 'n1': []})
+    assert unknown == ['id']
+    assert kept == [{'n0': 's0'}, {'n0': 's1', 'n1': 's0'}]
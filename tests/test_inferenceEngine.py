@@ -0,0 +1,105 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from pgmpy.inference import VariableElimination
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import py_src.inferenceEngine as inferenceEngine
+from py_src.Network import Network
+from networks import SyntheticNetwork
+
+"""
+Queries answered by the compiled elimination plans, compared with pgmpy's variable elimination and with
+contracting the whole network without pruning.
+"""
+
+
+def random_queries(synthetic, seed, count=20):
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(count):
+        nodes = [str(node) for node in rng.permutation(synthetic.names)]
+        sample = synthetic.sample()
+        variables = nodes[:rng.integers(1, 3)]
+        evidence = {node: sample[node] for node in nodes[2:2 + rng.integers(0, 5)]}
+        queries.append((variables, evidence))
+    return queries
+
+
+def values_in_order(factor, variables):
+    # pgmpy may order the axes of a joint result differently
+    return np.transpose(factor.values, [factor.variables.index(var) for var in variables])
+
+
+def test_plans_match_variable_elimination():
+    for seed in range(4):
+        synthetic = SyntheticNetwork(14, seed=seed)
+        model = Network(synthetic.to_string('bif'), 'bif').model
+        engine = inferenceEngine.get_engine(model)
+        eliminate = VariableElimination(model)
+        for variables, evidence in random_queries(synthetic, seed):
+            expected = values_in_order(eliminate.query(variables, evidence=evidence, show_progress=False), variables)
+            result = engine.query(variables, evidence)
+            assert result.variables == variables
+            assert np.allclose(result.values, expected, atol=1e-10), (seed, variables, evidence)
+
+            assignment = engine.map_query(variables, evidence)
+            best = np.unravel_index(np.argmax(expected), expected.shape)
+            # ties may be broken differently, the assignment only has to be as probable as the best one
+            assert abs(expected[tuple(engine.state_numbers[var][assignment[var]] for var in variables)]
+                       - expected[best]) < 1e-12
+
+
+def test_plans_are_shared_per_signature():
+    synthetic = SyntheticNetwork(14, seed=7)
+    model = Network(synthetic.to_string('bif'), 'bif').model
+    engine = inferenceEngine.get_engine(model)
+    plan = engine.plan(['n6', 'n12'], ['n3', 'n11'])
+    assert engine.plan(['n6', 'n12'], {'n11', 'n3'}) is plan  # the order of the evidence doesn't matter
+    assert engine.plan(['n12', 'n6'], ['n3', 'n11']) is not plan
+    results = [engine.query(['n6', 'n12'], {'n3': state, 'n11': synthetic.states['n11'][0]})
+               for state in synthetic.states['n3'][:2]]
+    assert engine.plan(['n6', 'n12'], ['n3', 'n11']) is plan
+    assert not np.allclose(results[0].values, results[1].values)  # same plan, other evidence values
+
+
+def query_without_pruning(engine, variables, evidence):
+    # every CPT in one contraction, the evidence entered as indicator vectors
+    symbols = {var: chr(ord('a') + i) for i, var in enumerate(engine.cpds)}
+    operands = []
+    for cpd in engine.cpds.values():
+        operands += [np.asarray(cpd.values, dtype=float), [symbols[var] for var in cpd.variables]]
+    for var, state in evidence.items():
+        indicator = np.zeros(engine.cardinality[var])
+        indicator[engine.state_numbers[var][state]] = 1
+        operands += [indicator, [symbols[var]]]
+    subscripts = ','.join(''.join(term) for term in operands[1::2]) + '->' + ''.join(symbols[var] for var in variables)
+    values = np.einsum(subscripts, *operands[::2])
+    return values / values.sum()
+
+
+def test_pruned_plans_match_the_whole_network():
+    pruned = ignored = 0
+    for seed in range(4):
+        synthetic = SyntheticNetwork(14, seed=seed)
+        engine = inferenceEngine.get_engine(Network(synthetic.to_string('bif'), 'bif').model)
+        for variables, evidence in random_queries(synthetic, seed + 100):
+            plan = engine.plan(variables, evidence.keys())
+            pruned += len(plan.factors) < len(engine.cpds)
+            ignored += bool(plan.ignored_evidence)
+            assert np.allclose(engine.query(variables, evidence).values,
+                               query_without_pruning(engine, variables, evidence), atol=1e-10), (seed, variables)
+    assert pruned and ignored  # the queries exercise both kinds of pruning
+
+
+def test_unknown_state_of_ignored_evidence_raises():
+    synthetic = SyntheticNetwork(12, seed=4)
+    engine = inferenceEngine.get_engine(Network(synthetic.to_string('bif'), 'bif').model)
+    assert engine.plan(['n7'], ['n4', 'n0']).ignored_evidence == {'n0'}
+    with pytest.raises(KeyError):
+        engine.query(['n7'], {'n4': synthetic.states['n4'][0], 'n0': 'unknown'})
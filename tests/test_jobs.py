@@ -0,0 +1,71 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import py_src.jobs as jobs
+
+"""
+Jobs whose worker died are reported as failed instead of running forever.
+"""
+
+
+def insert_running_job(database, job_id, heartbeat, owner='other', pid=None):
+    with sqlite3.connect(database) as connection:
+        connection.execute("INSERT INTO jobs (id, kind, status, progress, created, owner, host, pid, heartbeat) "
+                           "VALUES (?, 'calcOptions', 'running', 50, ?, ?, ?, ?, ?)",
+                           [job_id, heartbeat, owner, jobs.socket.gethostname(), pid, heartbeat])
+
+
+def test_job_without_heartbeat_fails_on_poll(tmp_path):
+    queue = jobs.JobQueue(str(tmp_path / 'jobs.sqlite'), stale_after=60)
+    insert_running_job(queue.database, 'stale', time.time() - 120)
+    job = queue.get('stale')
+    assert job['status'] == 'failed' and 'stopped' in job['error']
+
+
+def test_job_of_earlier_process_with_same_pid_fails(tmp_path):
+    queue = jobs.JobQueue(str(tmp_path / 'jobs.sqlite'), stale_after=60)
+    insert_running_job(queue.database, 'restarted', time.time(), pid=os.getpid())
+    assert queue.get('restarted')['status'] == 'failed'
+
+
+class Clock:
+    # time of the job table, advanced by the test instead of sleeping
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def heartbeat(database, job_id):
+    with sqlite3.connect(database) as connection:
+        return connection.execute('SELECT heartbeat FROM jobs WHERE id = ?', [job_id]).fetchone()[0]
+
+
+def test_jobs_of_this_queue_keep_running(tmp_path):
+    clock = Clock()
+    queue = jobs.JobQueue(str(tmp_path / 'jobs.sqlite'), stale_after=60, heartbeat_interval=0.01, clock=clock)
+    release = threading.Event()
+    job_id = queue.submit('calcOptions', lambda progress: release.wait(10) and {'value': 1})
+    wait_until(lambda: queue.get(job_id)['status'] == 'running')
+
+    clock.now += 120  # the heartbeat of the submission is stale now, the next beat renews it
+    wait_until(lambda: heartbeat(queue.database, job_id) == clock.now)
+    assert queue.get(job_id)['status'] == 'running'
+
+    release.set()
+    wait_until(lambda: queue.get(job_id)['status'] != 'running')
+    assert queue.get(job_id) == {'jobId': job_id, 'kind': 'calcOptions', 'status': 'done', 'progress': 100.0,
+                                 'result': {'value': 1}}
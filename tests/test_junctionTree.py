@@ -0,0 +1,52 @@
+import os
+import sys
+
+import numpy as np
+from pgmpy.inference import VariableElimination
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import py_src.relevance as relevance
+from py_src.Scenario import Scenario
+from networks import SyntheticNetwork
+
+"""
+The node marginals read off the junction tree calibrations are the ones pgmpy's variable elimination gives.
+"""
+
+
+def nodes_by_elimination(model, evidences):
+    # the former compute_all_nodes: two variable elimination queries per node without evidence
+    infer = VariableElimination(model)
+    nodes = {}
+    for node in model.nodes():
+        if node in evidences:
+            continue
+        distribution = infer.query([node], evidence=evidences, show_progress=False).values
+        distribution_wo_evidence = infer.query([node], show_progress=False).values
+        nodes[node] = (distribution, distribution_wo_evidence,
+                       relevance.compute_jensen_shannon_divergence(distribution, distribution_wo_evidence))
+    return nodes
+
+
+def test_junction_tree_marginals_match_variable_elimination():
+    for seed in range(6):
+        synthetic = SyntheticNetwork(12, seed=seed)
+        sample = synthetic.sample()
+        nodes = [str(node) for node in np.random.default_rng(seed).permutation(synthetic.names)]
+        evidences = {node: sample[node] for node in nodes[:4]}
+        scenario = Scenario(synthetic.to_string('bif'), 'bif', evidences=evidences)
+        assert scenario.network.get_junction_tree().tractable
+
+        results = scenario.compute_all_nodes()
+        expected = nodes_by_elimination(scenario.network.model, evidences)
+        order = list(scenario.network.states)
+        assert [r['name'] for r in results] == [node for node in order if node in evidences] + \
+            [node for node in order if node not in evidences]
+        for result in results[len(evidences):]:
+            distribution, distribution_wo_evidence, divergence = expected[result['name']]
+            assert np.allclose(result['distribution'], distribution, atol=1e-9), (seed, result['name'])
+            assert np.allclose(result['distribution_wo_evidence'], distribution_wo_evidence, atol=1e-9)
+            assert abs(result['divergence'] - divergence) < 1e-6
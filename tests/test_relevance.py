@@ -0,0 +1,90 @@
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import py_src.inferenceEngine as inferenceEngine
+import py_src.relevance as relevance
+from py_src.Network import Network
+from py_src.Scenario import Scenario
+from networks import SyntheticNetwork
+
+"""
+Relevance of the evidences for the goals, computed on a small synthetic network.
+"""
+
+
+def make_network():
+    synthetic = SyntheticNetwork(8, seed=1)
+    return synthetic, synthetic.to_string('bif')
+
+
+def test_influence_without_evidence_is_empty():
+    synthetic, fileString = make_network()
+    network = Network(fileString, 'bif')
+    goals = {'n7': synthetic.states['n7'][0]}
+    assert relevance.get_influence_of_evidences_on_goals(network, {}, goals, {'n7': 'max'}) == []
+
+
+def test_scenario_relevance_without_evidence_is_empty():
+    synthetic, fileString = make_network()
+    scenario = Scenario(fileString, 'bif', evidences={}, goals={'n7': synthetic.states['n7'][0]},
+                        goalDirections={'n7': 'max'})
+    assert scenario.compute_relevancies_for_goals() == []
+
+
+def test_influence_with_evidence_sums_to_one():
+    synthetic, fileString = make_network()
+    network = Network(fileString, 'bif')
+    sample = synthetic.sample()
+    evidences = {node: sample[node] for node in ['n0', 'n3']}
+    result = relevance.get_influence_of_evidences_on_goals(network, evidences, {'n7': sample['n7']}, {'n7': 'max'})
+    assert sorted(r['node_name'] for r in result) == ['n0', 'n3']
+    total = sum(r['overall_relevance'] for r in result)
+    assert total == 0 or abs(total - 1) < 1e-9
+
+
+def leave_one_out_by_elimination(network, evidences, goals):
+    # the distributions the variable elimination path of compute_leave_one_out_goal_distributions gives
+    infer = inferenceEngine.get_engine(network.model)
+    goalNames = list(goals)
+    distributions_wo = {e: infer.query(goalNames, {k: v for k, v in evidences.items() if k != e}).values
+                        for e in evidences}
+    return infer.query(goalNames, evidences).values, distributions_wo
+
+
+def test_retraction_matches_elimination_with_irrelevant_evidence():
+    for seed in range(12):
+        synthetic = SyntheticNetwork(12, seed=seed)
+        network = Network(synthetic.to_string('bif'), 'bif')
+        sample = synthetic.sample()
+        nodes = [str(node) for node in np.random.default_rng(seed).permutation(synthetic.names)]
+        goals = {node: sample[node] for node in (['n9', 'n7'] if seed == 4 else nodes[:2])}
+        evidences = {node: sample[node] for node in [node for node in nodes if node not in goals][:6]}
+        directions = {goal: 'max' for goal in goals}
+
+        retracted = relevance.get_influence_of_evidences_on_goals(network, evidences, goals, directions)
+        eliminated = relevance.get_influence_of_evidences_on_goals(
+            network, evidences, goals, directions, leave_one_out_by_elimination(network, evidences, goals))
+        assert [r['node_name'] for r in retracted] == [r['node_name'] for r in eliminated]
+        for a, b in zip(retracted, eliminated):
+            assert abs(a['overall_relevance'] - b['overall_relevance']) < 1e-6, (seed, retracted, eliminated)
+
+
+def test_evidence_d_separated_from_the_goals_has_no_relevance():
+    synthetic = SyntheticNetwork(12, seed=4)
+    network = Network(synthetic.to_string('bif'), 'bif')
+    sample = synthetic.sample()
+    goals = {'n9': sample['n9'], 'n7': sample['n7']}
+    evidences = {node: sample[node] for node in ['n0', 'n2', 'n4', 'n6', 'n10']}
+    independent = relevance.independent_evidences(network, evidences, goals)
+    assert independent == {'n0', 'n2', 'n6', 'n10'}  # only n4 reaches n7 through n5, n9 is an isolated root
+    result = relevance.get_influence_of_evidences_on_goals(network, evidences, goals, {'n9': 'max', 'n7': 'max'})
+    for r in result:
+        if r['node_name'] in independent:
+            assert r['overall_relevance'] == 0
+            assert all(value == 0 for value in r['relevancies'].values())
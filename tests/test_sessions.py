@@ -0,0 +1,64 @@
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from py_src.Scenario import Scenario
+from py_src.sessions import Session
+from networks import SyntheticNetwork
+
+"""
+A session moved incrementally through several evidence sets gives the same results as computing every
+evidence set from scratch.
+"""
+
+
+def relevances(relevance):
+    return {r['node_name']: r['overall_relevance'] for r in relevance}
+
+
+def check_session(seed, steps=10):
+    synthetic = SyntheticNetwork(12, seed=seed)
+    fileString = synthetic.to_string('bif')
+    sample = synthetic.sample()
+    rng = np.random.default_rng(seed)
+    nodes = [str(node) for node in rng.permutation(synthetic.names)]
+    goals = {node: sample[node] for node in nodes[:2]}
+    directions = {node: 'max' for node in goals}
+    candidates = nodes[2:]
+
+    session = None
+    evidences = {}
+    for _ in range(steps):
+        node = str(rng.choice(candidates))
+        if node in evidences:
+            del evidences[node]
+        else:
+            evidences[node] = sample[node]  # states of one forward sample always have a probability above zero
+
+        fresh = Scenario(fileString, 'bif', evidences=dict(evidences), goals=goals, goalDirections=directions)
+        if session is None:
+            session = Session(fresh.network, list(goals))
+        assert session.update(dict(evidences))
+        sessionNodes, distributions = session.results()
+
+        freshNodes = fresh.compute_all_nodes()
+        assert [n['name'] for n in sessionNodes] == [n['name'] for n in freshNodes]
+        for a, b in zip(sessionNodes, freshNodes):
+            if 'distribution' in b:
+                assert np.allclose(a['distribution'], b['distribution'], atol=1e-9)
+
+        expected = relevances(fresh.compute_relevancies_for_goals())
+        actual = relevances(fresh.compute_relevancies_for_goals(distributions))
+        assert actual.keys() == expected.keys()
+        for node in expected:
+            assert abs(actual[node] - expected[node]) < 1e-6, (seed, evidences, actual, expected)
+
+
+def test_session_updates_match_fresh_results():
+    for seed in range(6):
+        check_session(seed)
@@ -0,0 +1,89 @@
+import itertools
+import os
+import sys
+
+import numpy as np
+from pgmpy.inference import VariableElimination
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from py_src.Scenario import Scenario
+from networks import SyntheticNetwork
+
+"""
+The target combinations ranked from one joint query match one variable elimination query per combination,
+and the pages of that ranking put together give the whole ranking.
+"""
+
+
+def options_by_elimination(model, evidences, targets, goals, goalDirections):
+    # the former compute_target_combs_for_goals: one query of the goals per target combination
+    infer = VariableElimination(model)
+    options = {}
+    for combination in itertools.product(*[model.get_cpds(t).state_names[t] for t in targets]):
+        distribution = infer.query(list(goals), evidence=dict(evidences, **dict(zip(targets, combination))),
+                                   show_progress=False)
+        achieved = distribution.values
+        goalValues = {}
+        for axis, goal in enumerate(distribution.variables):
+            state = distribution.name_to_no[goal][goals[goal]]
+            marginal = np.moveaxis(distribution.values, axis, 0).reshape(achieved.shape[axis], -1).sum(axis=1)
+            goalValues[goal] = float(marginal[state])
+            mask = np.zeros(achieved.shape[axis])
+            mask[state] = 1
+            if goalDirections[goal] == 'min':
+                mask = 1 - mask
+            achieved = np.moveaxis(np.moveaxis(achieved, axis, -1) * mask, -1, axis)
+        options[combination] = (float(achieved.sum()), goalValues)
+    return options
+
+
+def make_scenario(seed, target_count=2):
+    synthetic = SyntheticNetwork(12, seed=seed)
+    sample = synthetic.sample()
+    nodes = [str(node) for node in np.random.default_rng(seed).permutation(synthetic.names)]
+    goals = {node: sample[node] for node in nodes[:2]}
+    goalDirections = {nodes[0]: 'max', nodes[1]: 'min'}
+    targets = nodes[2:2 + target_count]
+    evidences = {node: sample[node] for node in nodes[2 + target_count:5 + target_count]}
+    return Scenario(synthetic.to_string('bif'), 'bif', evidences=evidences, targets=targets, goals=goals,
+                    goalDirections=goalDirections)
+
+
+def test_target_combinations_match_one_query_per_combination():
+    for seed in range(6):
+        scenario = make_scenario(seed)
+        patient = scenario.patient
+        results = scenario.compute_target_combs_for_goals()
+        expected = options_by_elimination(scenario.network.model, patient.evidences, patient.targets,
+                                          patient.goals, patient.goalDirections)
+
+        assert len(results) == len(expected)
+        values = [result['value'] for result in results]
+        assert all(a >= b - 1e-9 for a, b in zip(values, values[1:]))
+        for result in results:
+            value, goalValues = expected[tuple(result['option'][t] for t in patient.targets)]
+            assert abs(result['value'] - value) < 1e-9, (seed, result)
+            for goal, goalValue in goalValues.items():
+                assert abs(result['goalValues'][goal] - goalValue) < 1e-9
+
+
+def test_pages_of_the_ranking_match_the_full_ranking():
+    for seed in range(6):
+        scenario = make_scenario(seed, target_count=3)
+        ranking = scenario.compute_target_combs_for_goals()
+        for top_k in (1, 4, 10):
+            pages = []
+            cursor = 0
+            while cursor is not None:
+                page, cursor = scenario.compute_top_target_combs_for_goals(top_k, cursor)
+                assert len(page) == min(top_k, len(ranking) - len(pages))
+                pages.extend(page)
+            assert [r['option'] for r in pages] == [r['option'] for r in ranking], (seed, top_k)
+            for paged, full in zip(pages, ranking):
+                assert abs(paged['value'] - full['value']) < 1e-9
+                assert paged['goalValues'].keys() == full['goalValues'].keys()
+                for goal in full['goalValues']:
+                    assert abs(paged['goalValues'][goal] - full['goalValues'][goal]) < 1e-9